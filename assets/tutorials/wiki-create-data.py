@@ -1,30 +1,21 @@
-import gzip
 import json
-import os
-import shutil
 import re
 import wiki
 import wikitext
 
-assert wiki.__version__ >= 6
+assert wiki.__version__ >= 8
 
 def create_zip_file(links, name):
     """Downloads a set of links from Wikipedia and saves as zip file
+
+    The manifest of the archive, listing the titles that succeeded and
+    failed, is saved next to it as a JSON file.
     """
-    links = list(set(links))  # make sure list is unique
-    if not os.path.exists(name):
-        os.mkdir(name)
-    for page_title in links:
-        try:
-            page_data = wiki.download_wiki_json(page_title)
-            file_path = wiki.wiki_json_path(page_title)
-            file_path = os.path.split(file_path)[1]
-            file_path = os.path.join(name, file_path)
-            with gzip.open(file_path, 'wt') as outfile:
-                json.dump(page_data, outfile)
-        except:
-            pass
-    shutil.make_archive(name, 'zip', name)
+    manifest = wiki.build_archive(links, name)
+    with open(name + "-manifest.json", 'w') as outfile:
+        json.dump(manifest, outfile, indent=1)
+
+    return manifest
 
 
 # birthday cake
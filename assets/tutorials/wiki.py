@@ -2,22 +2,85 @@
 """Functions to grab and parse data from the MediaWiki API.
 """
 
-import gzip
-import json
+import asyncio
+import atexit
+import contextlib
+import email.utils
 import os
-from os.path import join
+import queue
+import random
 import re
-import shutil
 import tempfile
+import threading
 import time
 import urllib.parse
-import urllib.request
 import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+# not the builtin TimeoutError before Python 3.11
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
 import requests
+from requests.adapters import HTTPAdapter
 
+import wikicache
 
-__version__ = 6
+
+__version__ = 9
+
+# One shared HTTP session, so that connections to the MediaWiki API and
+# the image servers are kept alive and reused across calls and threads.
+DEFAULT_USER_AGENT = "stat289-wiki/{0:d} " \
+    "(https://statsmaths.github.io/stat289-f18/) " \
+    "python-requests/{1:s}".format(__version__, requests.__version__)
+_SESSION_LOCK = threading.Lock()
+
+# Address of the MediaWiki API, with '{lang}' standing for the language
+# code. The WIKI_API_URL environment variable or set_api_url replace it,
+# for instance to point at a local wikiserver.WikiServer.
+DEFAULT_API_URL = 'https://{lang}.wikipedia.org/w/api.php'
+_API_STATE = dict(url=os.environ.get('WIKI_API_URL', DEFAULT_API_URL))
+
+# Seconds to wait for a connection and then for each read from the server
+DEFAULT_TIMEOUT = (10, 60)
+
+# Properties that can be requested from the parse action of the API
+PARSE_PROPS = ('text', 'langlinks', 'categories', 'links', 'templates',
+               'images', 'externallinks', 'sections', 'revid',
+               'displaytitle', 'iwlinks', 'properties')
+
+# Properties that can be requested by query_pages, with the name of the
+# matching prop of the query action and of its limit parameter
+QUERY_PROPS = dict(info=('info', None), langlinks=('langlinks', 'lllimit'),
+                   links=('links', 'pllimit'),
+                   categories=('categories', 'cllimit'),
+                   extlinks=('extlinks', 'ellimit'),
+                   images=('images', 'imlimit'))
+QUERY_BATCH_SIZE = 50
+
+# HTTP status codes of responses that are worth trying again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# MediaWiki API error codes meaning that a page does not exist
+MISSING_PAGE_CODES = ('missingtitle', 'invalidtitle', 'nosuchpageid',
+                      'nosuchrevid')
+
+# Member of the archives written by build_archive listing the aliases of
+# the pages, one tab separated alias and key per line
+ARCHIVE_ALIASES = '_aliases.tsv'
+
+# Backend used to store pages returned by get_wiki_json, and the in-memory
+# cache of recently used pages kept in front of it
+_CACHE_STATE = dict(cache=wikicache.FileCache())
+_MEMORY_CACHE = wikicache.MemoryCache()
+_SESSION_STATE = dict(session=None, user_agent=DEFAULT_USER_AGENT,
+                      pool_connections=10, pool_maxsize=16,
+                      host_pool_sizes={}, timeout=DEFAULT_TIMEOUT)
+
+# Background prefetching of the links of loaded pages; off until
+# configure_prefetch is called
+_PREFETCH_LOCK = threading.Lock()
+_PREFETCH_STATE = dict(queue=None, num_workers=0, max_bytes=0, num_bytes=0,
+                       num_pages=0, queued=set())
 
 
 def wiki_json_path(page_title, lang='en'):
@@ -36,20 +99,14 @@ def wiki_json_path(page_title, lang='en'):
     Returns:
         A string describing a relative path to file.
     """
-    page_title = re.sub("[ /]", "_", page_title)
-    stat289_base_dir = os.path.dirname(os.getcwd())
-
-    dir_name = join(stat289_base_dir, "data", lang)
-    if not os.path.exists(dir_name):
-        os.makedirs(dir_name)
+    cache = _CACHE_STATE['cache']
+    if not isinstance(cache, wikicache.FileCache):
+        cache = wikicache.FileCache()
 
-    file_name = page_title + ".json.gz"
-    file_path = join(dir_name, file_name)
+    return cache.path(page_title, lang)
 
-    return file_path
 
-
-def get_mediawiki_request(page_title, lang):
+def get_mediawiki_request(page_title, lang, props=None):
     """Returns URL to make parse request to the MediaWiki API.
 
     See naming rules of MediaWiki pages:
@@ -62,6 +119,8 @@ def get_mediawiki_request(page_title, lang):
         page_title: A string containing the page title.
         lang: Two letter language code describing the Wikipedia
             language used to grab the data.
+        props: Optional list of properties to request, from PARSE_PROPS.
+            If None, the API returns all of the default properties.
 
     Returns:
         A string giving the complete request URL.
@@ -73,118 +132,2016 @@ def get_mediawiki_request(page_title, lang):
     page_title = re.sub("\'", "%27", page_title)
     page_title = re.sub("\\+", "%2B", page_title)
 
-    base_api_url = 'https://' + lang + '.wikipedia.org/w/api.php'
-    default_query = 'action=parse&format=json&redirects&'
+    base_api_url = get_api_url(lang)
+    default_query = 'action=parse&format=json&redirects&maxlag=5&'
     url = base_api_url + "?" + default_query + 'page=' + page_title
+    if props is not None:
+        url += '&prop=' + '|'.join(sorted(set(props) | set(['revid'])))
 
     return url
 
 
-def get_wiki_json(page_title, lang='en'):
+def set_api_url(url=None):
+    """Set the address of the MediaWiki API used by every request.
+
+    Args:
+        url: URL of the api.php endpoint, in which '{lang}' is replaced by
+            the language code of each request. If None, the default
+            DEFAULT_API_URL is restored.
+    """
+    _API_STATE['url'] = DEFAULT_API_URL if url is None else url
+
+
+def get_api_url(lang='en'):
+    """Returns the address of the MediaWiki API for a language.
+
+    Args:
+        lang: Two letter language code describing the Wikipedia
+            language used to grab the data.
+
+    Returns:
+        A string such as 'https://en.wikipedia.org/w/api.php'.
+    """
+    return _API_STATE['url'].replace('{lang}', lang)
+
+
+def absolute_url(url, lang='en'):
+    """Resolve a link found in page HTML against the address of the API.
+
+    Pages link to images with protocol-relative URLs such as
+    '//upload.wikimedia.org/...'; these take the scheme of the API, and
+    relative URLs are taken relative to the API server.
+
+    Args:
+        url: A URL string, possibly relative.
+        lang: Two letter language code describing the Wikipedia
+            language used to grab the data.
+
+    Returns:
+        An absolute URL string.
+    """
+    return urllib.parse.urljoin(get_api_url(lang), url)
+
+
+def get_wiki_json(page_title, lang='en', props=None):
     """Returns JSON data as a dictionary for the Wikipedia page.
 
     This function either loads a cached version of the page or,
     if a local version of the page is not available, calls the
-    MediaWiki API directly.
+    MediaWiki API directly. Pages are stored in the cache backend
+    given to set_cache under the title returned by the API (optionally
+    in the background, see configure_write_behind), and the
+    requested title and any redirects followed are recorded in the
+    alias index of the cache, so that all of them find the same entry.
+    Recently used pages are also kept in memory (see
+    configure_memory_cache). If background prefetching is turned on
+    with configure_prefetch, the links of the page are then queued for
+    download into the cache. The returned dictionary may be shared
+    with other callers and should not be modified.
 
     Args:
         page_title: A string containing the page title.
         lang: Two letter language code describing the Wikipedia
             language used to grab the data.
+        props: Optional list of the properties needed, such as ['links']
+            or ['langlinks', 'sections']; see PARSE_PROPS. Unless the
+            complete page is already cached, only these properties are
+            requested from the API and they are cached as a separate,
+            partial entry. Asking for 'text' always loads the complete
+            page.
 
     Returns:
-        A dictionary object with the complete parsed JSON data.
+        A dictionary object with the complete parsed JSON data. When props
+        is given, the dictionary may instead hold only the requested
+        properties together with the title, pageid and revid.
     """
-    file_path = wiki_json_path(page_title, lang)
+    page_data = _load_wiki_json(page_title, lang, props)
+    _queue_prefetch(page_data, lang)
 
-    # if page does not exist, grab it from Wikipedia
-    if not os.path.exists(file_path):
-        page_data = download_wiki_json(page_title, lang)
+    return page_data
+
+
+def get_wiki_json_many(page_titles, lang='en', max_workers=8, failures=None,
+                       props=None, deadline=None):
+    """Yields JSON data for many Wikipedia pages, fetched concurrently.
+
+    Pages already in the local cache are loaded directly; the others are
+    downloaded by a pool of worker threads that share the same rate limit
+    as get_wiki_json. Results are stored in the same cache as
+    get_wiki_json and are yielded in the order that they finish, not the
+    order of the input. If a deadline is given, pages that have not
+    finished when it passes are treated as failures and the generator
+    returns without waiting for them; downloads already running are
+    left to finish in the background.
+
+    Args:
+        page_titles: An iterable of strings containing page titles.
+        lang: Two letter language code describing the Wikipedia
+            language used to grab the data.
+        max_workers: Maximum number of pages to fetch at the same time.
+        failures: Optional dictionary. If given, titles that could not be
+            fetched are added as keys, with the raised exception as value.
+        props: Optional list of the properties needed, as in get_wiki_json.
+        deadline: Optional number of seconds allowed for the whole batch.
+
+    Yields:
+        Tuples of a page title, as given in page_titles, and the
+        dictionary that get_wiki_json returns for the page.
+    """
+    # downloads left running after the deadline still write to this cache
+    cache = get_cache()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}
+    timed_out = False
+    try:
+        for titles in _group_titles(page_titles):
+            future = executor.submit(_load_wiki_json, titles[0], lang, props,
+                                     cache)
+            futures[future] = titles
+
+        unfinished = set(futures)
+        completed = as_completed(futures, timeout=deadline)
+        while True:
+            try:
+                future = next(completed)
+            except StopIteration:
+                break
+            except FuturesTimeoutError:
+                timed_out = True
+                break
+
+            unfinished.discard(future)
+            titles = futures[future]
+            try:
+                page_data = future.result()
+            except IOError as err:
+                print("Failed to load page '" + titles[0] + "': " + str(err))
+                if failures is not None:
+                    for page_title in titles:
+                        failures[page_title] = err
+                continue
+
+            for page_title in titles:
+                yield page_title, page_data
+
+        if timed_out:
+            msg = "Deadline passed with {0:d} pages unfinished."
+            print(msg.format(len(unfinished)))
+            err = TimeoutError("Deadline of {0} seconds passed".format(
+                deadline))
+            for future in unfinished:
+                if failures is not None:
+                    for page_title in futures[future]:
+                        failures[page_title] = err
+    finally:
+        # stop any pending downloads if the caller stops iterating early
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=not timed_out)
+
+
+def query_pages(page_titles, props=('info',), lang='en'):
+    """Returns metadata about many pages using the query action of the API.
+
+    Titles are sent QUERY_BATCH_SIZE at a time in a single request, and
+    continuation requests are followed until all of the data for each
+    batch has been returned. This is much cheaper than calling
+    get_wiki_json when only counts or link lists are needed. Results are
+    not cached.
+
+    Args:
+        page_titles: An iterable of strings containing page titles.
+        props: List of properties to return, from the keys of QUERY_PROPS.
+            Basic information about each page (pageid, revid, length) is
+            always included.
+        lang: Two letter language code describing the Wikipedia
+            language used to grab the data.
+
+    Returns:
+        A pandas DataFrame with one row for each unique title. The columns
+        'link', 'title', 'pageid', 'revid', 'length' and 'missing' are
+        always present; 'langlinks' adds 'num_langs' and 'langs', 'links'
+        adds 'num_ilinks' and 'ilinks' (namespace 0 only), 'categories'
+        adds 'num_categories', 'extlinks' adds 'num_elinks' and 'images'
+        adds 'num_images'.
+    """
+    import pandas as pd
+
+    unknown = set(props) - set(QUERY_PROPS)
+    if unknown:
+        raise ValueError('Unknown props: ' + ', '.join(sorted(unknown)))
+    props = sorted(set(props) | set(['info']))
+    page_titles = list(dict.fromkeys(page_titles))
+
+    meta = dict(link=[], title=[], pageid=[], revid=[], length=[],
+                missing=[])
+    if 'langlinks' in props:
+        meta.update(num_langs=[], langs=[])
+    if 'links' in props:
+        meta.update(num_ilinks=[], ilinks=[])
+    if 'categories' in props:
+        meta.update(num_categories=[])
+    if 'extlinks' in props:
+        meta.update(num_elinks=[])
+    if 'images' in props:
+        meta.update(num_images=[])
+
+    for start in range(0, len(page_titles), QUERY_BATCH_SIZE):
+        batch = page_titles[start:(start + QUERY_BATCH_SIZE)]
+        pages, resolve = _query_batch(batch, props, lang)
+
+        for page_title in batch:
+            page = pages.get(resolve(page_title), dict(missing=True))
+            meta['link'].append(page_title)
+            meta['title'].append(page.get('title'))
+            meta['pageid'].append(page.get('pageid'))
+            meta['revid'].append(page.get('lastrevid'))
+            meta['length'].append(page.get('length'))
+            meta['missing'].append('missing' in page or 'invalid' in page)
+            if 'langlinks' in props:
+                langs = [x['lang'] for x in page.get('langlinks', [])]
+                meta['num_langs'].append(len(langs))
+                meta['langs'].append(langs)
+            if 'links' in props:
+                links = page.get('links', [])
+                meta['num_ilinks'].append(len(links))
+                meta['ilinks'].append([re.sub(' ', '_', x['title']) for x
+                                       in links if x['ns'] == 0])
+            if 'categories' in props:
+                meta['num_categories'].append(len(page.get('categories',
+                                                           [])))
+            if 'extlinks' in props:
+                meta['num_elinks'].append(len(page.get('extlinks', [])))
+            if 'images' in props:
+                meta['num_images'].append(len(page.get('images', [])))
+
+    return pd.DataFrame(meta)
+
+
+def revalidate(lang='en', max_workers=8, page_titles=None):
+    """Refresh cached pages that have changed on Wikipedia.
+
+    The current revid of every cached page is looked up with batched
+    calls to query_pages, and only the pages whose revid differs from the
+    one stored in the cache are downloaded again. Both the lookups and
+    the downloads run concurrently.
+
+    Args:
+        lang: Two letter language code describing the Wikipedia
+            language used to grab the data.
+        max_workers: Maximum number of requests to make at the same time.
+        page_titles: Optional list of titles to check. If None, every page
+            cached for the language is checked.
+
+    Returns:
+        A dictionary with the number of pages checked and lists of the
+        cache keys of the pages that were 'refreshed', that are 'missing'
+        from Wikipedia (these are left in the cache), and that 'failed' to
+        download.
+    """
+    cache = get_cache()
+    stored = cache.revids(lang)
+    if page_titles is not None:
+        keys = set(wikicache.normalize_title(x) for x in page_titles)
+        stored = dict((k, v) for k, v in stored.items() if k in keys)
+
+    # keys lose the difference between '/' and '_', so the API is asked
+    # about the titles stored with them and its answers mapped back
+    keys_by_title = {}
+    for key, (title, _) in stored.items():
+        keys_by_title.setdefault(title, []).append(key)
+
+    keys = sorted(stored)
+    titles = sorted(keys_by_title)
+    batches = [titles[i:(i + QUERY_BATCH_SIZE)] for i in
+               range(0, len(titles), QUERY_BATCH_SIZE)]
+
+    changed = []
+    missing = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for pdf in executor.map(lambda x: query_pages(x, lang=lang), batches):
+            for link, revid, is_missing in zip(pdf['link'], pdf['revid'],
+                                               pdf['missing']):
+                for key in keys_by_title[link]:
+                    if is_missing:
+                        missing.append(key)
+                    elif stored[key][1] != revid:
+                        changed.append(key)
+
+        refreshed = []
+        failed = []
+        futures = dict((executor.submit(_refresh_wiki_json, stored[x][0],
+                                        lang), x) for x in changed)
+        for future in as_completed(futures):
+            try:
+                future.result()
+                refreshed.append(futures[future])
+            except IOError as err:
+                print("Failed to refresh page '" + futures[future] + "': " +
+                      str(err))
+                failed.append(futures[future])
+
+    msg = "Checked {0:d} pages and refreshed {1:d} of {2:d} changed pages."
+    print(msg.format(len(keys), len(refreshed), len(changed)))
+
+    return dict(num_checked=len(keys), refreshed=sorted(refreshed),
+                missing=sorted(missing), failed=sorted(failed))
+
+
+def set_cache(cache):
+    """Set the backend used to cache pages from the MediaWiki API.
+
+    Args:
+        cache: A cache object, such as wikicache.FileCache (the default,
+            one gzip file per page) or wikicache.SQLiteCache (all pages in
+            a single SQLite database file).
+    """
+    _CACHE_STATE['cache'] = cache
+    _MEMORY_CACHE.clear()
+
+
+def get_cache():
+    """Returns the backend used to cache pages from the MediaWiki API.
+
+    Returns:
+        A cache object from the wikicache module.
+    """
+    return _CACHE_STATE['cache']
+
+
+def configure_memory_cache(max_bytes):
+    """Set the size of the in-memory cache of recently used pages.
+
+    Args:
+        max_bytes: Maximum total size of the pages held in memory, in
+            serialized bytes. Set to zero to disable the cache.
+    """
+    _MEMORY_CACHE.resize(max_bytes)
+
+
+def configure_prefetch(max_workers=2, max_bytes=64 * 2 ** 20,
+                       max_queue=500):
+    """Turn background prefetching of linked pages on or off.
+
+    When prefetching is on, each page returned by get_wiki_json has its
+    existing links in the main namespace queued for download into the
+    cache by a small pool of background threads, so that building a
+    corpus from those links mostly reads from the cache. Prefetching
+    shares the rate limit of other requests, and stops once max_bytes
+    of new cache entries have been written.
+
+    Args:
+        max_workers: Number of background threads. Set to zero to turn
+            prefetching off, which is the default.
+        max_bytes: Maximum total size, in stored bytes, of the pages
+            downloaded by prefetching.
+        max_queue: Maximum number of links waiting to be fetched; further
+            links are dropped until there is room.
+    """
+    with _PREFETCH_LOCK:
+        old_queue = _PREFETCH_STATE['queue']
+        num_old = _PREFETCH_STATE['num_workers']
+        new_queue = None
+        if max_workers > 0:
+            new_queue = queue.Queue(maxsize=max(max_queue, 1))
+        _PREFETCH_STATE.update(queue=new_queue, num_workers=max_workers,
+                               max_bytes=max_bytes, num_bytes=0, num_pages=0,
+                               queued=set())
+
+    # drop pending links and stop the old threads
+    if old_queue is not None:
+        while True:
+            try:
+                old_queue.get_nowait()
+            except queue.Empty:
+                break
+        for _ in range(num_old):
+            old_queue.put(None)
+
+    for _ in range(max_workers):
+        thread = threading.Thread(target=_prefetch_worker, args=(new_queue,),
+                                  daemon=True)
+        thread.start()
+
+
+def prefetch_info():
+    """Returns statistics about background prefetching.
+
+    Returns:
+        A dictionary with whether prefetching is enabled, the number of
+        links waiting, the number of pages and bytes downloaded so far,
+        and the maximum number of bytes.
+    """
+    with _PREFETCH_LOCK:
+        prefetch_queue = _PREFETCH_STATE['queue']
+        return dict(enabled=prefetch_queue is not None,
+                    waiting=0 if prefetch_queue is None else
+                    prefetch_queue.qsize(),
+                    pages=_PREFETCH_STATE['num_pages'],
+                    bytes=_PREFETCH_STATE['num_bytes'],
+                    max_bytes=_PREFETCH_STATE['max_bytes'])
+
+
+def configure_write_behind(max_queue=0, num_workers=2):
+    """Set how newly downloaded pages are written to the cache.
+
+    By default get_wiki_json writes each new page to the cache before
+    returning it. When max_queue is above zero, a page is returned as
+    soon as it is downloaded and is encoded and written to the cache by
+    background threads. Until it is written, later calls for the page get
+    it from the queue, and the lock of the cache for the page stays held,
+    so that other processes wait for the write rather than download the
+    page again. When the queue is full, downloads wait for room. Writes
+    still queued when Python exits are finished first; a process forked
+    while writes are queued leaves them to its parent.
+
+    Args:
+        max_queue: Maximum number of pages waiting to be written. Zero,
+            the default, turns background writing off.
+        num_workers: Number of background threads writing pages.
+    """
+    _WRITER.configure(max_queue, num_workers)
+
+
+def flush_writes():
+    """Wait until every page queued for writing is in the cache.
+    """
+    _WRITER.flush()
+
+
+def memory_cache_info():
+    """Returns statistics about the in-memory cache of pages.
+
+    Returns:
+        A dictionary with the number of hits, misses, pages held, bytes
+        used and the maximum number of bytes.
+    """
+    return _MEMORY_CACHE.info()
+
+
+class RateLimiter():
+    """Adaptive token bucket limiting the rate of calls to Wikipedia.
+
+    Tokens are added at the current rate, up to a maximum of burst tokens,
+    and each call takes one token. After each successful call the rate is
+    increased a little, up to max_rate. When the server pushes back, with
+    an HTTP 429 status, a Retry-After header or a MediaWiki maxlag error,
+    the rate is halved, down to min_rate, and all callers wait until the
+    requested time has passed. One object can be shared by any number of
+    threads and asyncio tasks.
+
+    Args:
+        rate: Starting number of requests per second.
+        burst: Maximum number of requests that can be made at once after
+            a period without calls.
+        min_rate: Smallest number of requests per second.
+        max_rate: Largest number of requests per second.
+        increase: Amount added to the rate after each successful call.
+    """
+    def __init__(self, rate=5.0, burst=5, min_rate=0.2, max_rate=10.0,
+                 increase=0.1):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, rate)
+        self.increase = increase
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def __str__(self):
+        msg = "RateLimiter object at {0:.2f} requests per second (range " \
+              "{1:.2f} to {2:.2f})."
+        return msg.format(self.rate, self.min_rate, self.max_rate)
+
+    def acquire(self):
+        """Block the current thread until a call is allowed.
+        """
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        """Wait, without blocking the event loop, until a call is allowed.
+        """
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def success(self):
+        """Record a call that was not throttled by the server.
+        """
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttle(self, retry_after=None):
+        """Record a call that was throttled by the server.
+
+        Args:
+            retry_after: Number of seconds the server asked us to wait. If
+                None, wait for the time between two calls at the new rate.
+        """
+        with self._lock:
+            now = time.monotonic()
+            # calls already in flight during a pause only extend it
+            if now >= self._blocked_until:
+                self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after is None:
+                retry_after = 1.0 / self.rate
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+            self._tokens = min(self._tokens, 0.0)
+
+    def _reserve(self):
+        """Take a token and return the number of seconds to wait for it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated
+            self._updated = now
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            self._tokens -= 1
+
+            delay = max(0.0, self._blocked_until - now)
+            if self._tokens < 0:
+                delay += -self._tokens / self.rate
+
+        return delay
+
+
+# A single rate limiter shared by every call to Wikipedia in the process
+_RATE_LIMITER = RateLimiter()
+
+
+def get_rate_limiter():
+    """Returns the rate limiter shared by all calls to Wikipedia.
+
+    Returns:
+        A RateLimiter object.
+    """
+    return _RATE_LIMITER
+
+
+def set_rate_limit(requests_per_second, max_requests_per_second=None):
+    """Set the rate of calls to Wikipedia.
+
+    The limit is shared by every thread in the process. The rate adapts
+    from the given starting value based on responses from the server.
+
+    Args:
+        requests_per_second: Positive number of requests allowed per second.
+        max_requests_per_second: Optional upper bound for the rate. If None,
+            the current upper bound is kept unless it is below the new rate.
+    """
+    if requests_per_second <= 0:
+        raise ValueError('requests_per_second must be positive')
+    with _RATE_LIMITER._lock:
+        _RATE_LIMITER.rate = requests_per_second
+        if max_requests_per_second is not None:
+            _RATE_LIMITER.max_rate = max_requests_per_second
+        _RATE_LIMITER.max_rate = max(_RATE_LIMITER.max_rate,
+                                     requests_per_second)
+        _RATE_LIMITER.min_rate = min(_RATE_LIMITER.min_rate,
+                                     requests_per_second)
+
+
+class WikiError(IOError):
+    """Error raised when a request to Wikipedia fails.
+
+    Args:
+        message: String describing the error.
+        status_code: Optional integer HTTP status code of the response.
+    """
+    retryable = False
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class TransientError(WikiError):
+    """Error that may go away if the request is made again later.
+    """
+    retryable = True
+
+
+class PageNotFoundError(WikiError):
+    """Error raised when the requested page does not exist.
+    """
+
+
+class RetryPolicy():
+    """How many times, and after how long, failed requests are tried again.
+
+    Requests are tried again after timeouts, dropped connections and
+    responses with one of the retry_statuses. The delay before each new
+    try is drawn at random between zero and a bound that starts at
+    base_delay and doubles with every attempt, up to max_delay, so that
+    many threads failing at the same time do not all come back together.
+    A delay asked for by the server with a Retry-After header is always
+    respected.
+
+    Args:
+        max_attempts: Total number of tries for each request.
+        base_delay: Bound on the delay, in seconds, after the first try.
+        max_delay: Largest bound on the delay, in seconds.
+        retry_statuses: HTTP status codes of responses to try again.
+    """
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30.0,
+                 retry_statuses=RETRY_STATUSES):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = tuple(retry_statuses)
+
+    def __str__(self):
+        msg = "RetryPolicy object with {0:d} attempts and delays of up to " \
+              "{1:.1f} seconds."
+        return msg.format(self.max_attempts, self.max_delay)
+
+    def should_retry(self, status_code):
+        """Check whether a response with the given status is tried again.
+        """
+        return status_code in self.retry_statuses
+
+    def delay(self, attempt, retry_after=None):
+        """Returns the number of seconds to wait after a failed attempt.
+
+        Args:
+            attempt: Number of the attempt that failed, starting at zero.
+            retry_after: Optional number of seconds the server asked for.
+        """
+        bound = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = random.uniform(0, bound)
+        if retry_after:
+            delay = max(delay, retry_after)
+
+        return delay
+
+
+_RETRY_STATE = dict(policy=RetryPolicy())
+
+
+def set_retry_policy(policy):
+    """Set the policy used to retry failed requests to Wikipedia.
+
+    Args:
+        policy: A RetryPolicy object. Use RetryPolicy(max_attempts=1) to
+            turn retries off.
+    """
+    _RETRY_STATE['policy'] = policy
+
+
+def get_retry_policy():
+    """Returns the RetryPolicy used by http_get and ahttp_get.
+    """
+    return _RETRY_STATE['policy']
+
+
+def configure_session(user_agent=None, pool_connections=10, pool_maxsize=16,
+                      host_pool_sizes=None, timeout=DEFAULT_TIMEOUT):
+    """Configure the HTTP session shared by all calls to Wikipedia.
+
+    All requests to the MediaWiki API and to the Wikimedia image servers
+    go through a single requests.Session, which keeps connections alive
+    between calls. Calling this function closes the current session; a
+    new one with the given settings is created on the next request.
+
+    Args:
+        user_agent: String sent as the User-Agent header. If None, uses
+            DEFAULT_USER_AGENT.
+        pool_connections: Number of distinct hosts to keep pools for.
+        pool_maxsize: Maximum number of connections kept open per host.
+            Should be at least as large as the number of worker threads.
+        host_pool_sizes: Optional dictionary mapping a URL prefix, such as
+            'https://upload.wikimedia.org/', to the maximum number of
+            connections kept open for that prefix.
+        timeout: Tuple of the connect and read timeouts, in seconds, used
+            by http_get unless a call gives its own.
+    """
+    if user_agent is None:
+        user_agent = DEFAULT_USER_AGENT
+    if host_pool_sizes is None:
+        host_pool_sizes = {}
+
+    with _SESSION_LOCK:
+        if _SESSION_STATE['session'] is not None:
+            _SESSION_STATE['session'].close()
+        _SESSION_STATE.update(session=None, user_agent=user_agent,
+                              pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              host_pool_sizes=dict(host_pool_sizes),
+                              timeout=timeout)
 
-        with gzip.open(file_path, 'wt') as outfile:
-            json.dump(page_data, outfile)
-        time.sleep(0.5)  # sleep for half second to avoid API limits
 
-    # read the JSON data from local filesystem
-    with gzip.open(file_path, 'rt') as infile:
-        new_data = json.load(infile)
+def get_session():
+    """Returns the HTTP session shared by all calls to Wikipedia.
 
-    return new_data
+    Returns:
+        A requests.Session object, created on first use with the settings
+        given to configure_session.
+    """
+    with _SESSION_LOCK:
+        if _SESSION_STATE['session'] is None:
+            _SESSION_STATE['session'] = _make_session()
+        return _SESSION_STATE['session']
+
+
+def http_get(url, **kwargs):
+    """Make a GET request using the shared HTTP session.
+
+    Every call waits on the shared rate limiter first. Responses where the
+    server asks us to slow down are reported to the rate limiter. These,
+    other server errors, timeouts and dropped connections are tried again
+    after the delays given by the retry policy (see set_retry_policy).
+    Unless a timeout is given, the timeouts set with configure_session are
+    used, so that a stalled connection raises requests.exceptions.Timeout,
+    a subclass of IOError, instead of hanging.
+
+    Args:
+        url: A string giving the complete request URL.
+        **kwargs: Additional arguments passed to requests.Session.get.
+
+    Returns:
+        A requests.Response object.
+    """
+    session = get_session()
+    kwargs.setdefault('timeout', _SESSION_STATE['timeout'])
+    policy = _RETRY_STATE['policy']
+    for attempt in range(policy.max_attempts):
+        last_attempt = attempt == policy.max_attempts - 1
+        _RATE_LIMITER.acquire()
+        try:
+            req = session.get(url, **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            if last_attempt:
+                raise
+            time.sleep(policy.delay(attempt))
+            continue
+
+        retry_after = _throttle_delay(req.status_code, req.headers)
+        if retry_after is None:
+            # server errors do not earn a faster rate
+            if req.status_code not in policy.retry_statuses:
+                _RATE_LIMITER.success()
+            if last_attempt or not policy.should_retry(req.status_code):
+                return req
+        else:
+            _RATE_LIMITER.throttle(retry_after or None)
+            if last_attempt:
+                return req
+
+        req.close()
+        time.sleep(policy.delay(attempt, retry_after))
 
+    return req
 
-def download_wiki_json(page_title, lang='en'):
+
+def download_wiki_json(page_title, lang='en', props=None):
     """Download json data file Wikipedia
     """
     print("Pulling data from MediaWiki API: '" + page_title + "'")
-    url = get_mediawiki_request(page_title, lang)
-    req = requests.get(url)
+    url = get_mediawiki_request(page_title, lang, props)
+    req = http_get(url)
     if req.status_code != requests.codes['ok']:
-        raise IOError('Website cannot be reached')
-    page_data = req.json()
-    if 'parse' not in page_data:
-        raise IOError('Wikipedia page not found')
+        return check_api_response(req.status_code, None)
 
-    return page_data['parse']
+    return check_api_response(req.status_code, req.json())
 
 
-def bulk_download(name, lang='en', force=False,
-                  base_url="http://distantviewing.org/"):
-    """Bulk download Wikipedia files
+def check_api_response(status_code, data, key='parse'):
+    """Check a response from the MediaWiki API and return its result.
 
     Args:
-        name: A character string describing the
-        lang: Two letter language code describing the Wikipedia
-            language used to grab the data.
-        force: Boolean value. Should files be overwritten.
-        base_url: The URL path that contains the zip file.
+        status_code: Integer HTTP status code of the response.
+        data: The decoded JSON body of the response, or None if it was
+            not read.
+        key: Name of the element of the body holding the result, such as
+            'parse' or 'query'.
+
     Returns:
-        Number of files added to the archive.
+        The element of data given by key.
+
+    Raises:
+        TransientError: For server errors, throttling and API errors that
+            may go away when the request is made again later.
+        PageNotFoundError: If the page does not exist.
+        WikiError: For any other error.
     """
-    # get file paths
-    zip_file_url = base_url + name + ".zip"
-    zip_file = tempfile.NamedTemporaryFile().name + ".zip"
-    zip_dir = tempfile.NamedTemporaryFile().name
-    stat289_json_dir = os.path.dirname(os.getcwd())
-    stat289_json_dir = join(stat289_json_dir, "data", lang)
+    if status_code != requests.codes['ok']:
+        msg = "Website cannot be reached (HTTP {0:d})".format(status_code)
+        if status_code in RETRY_STATUSES:
+            raise TransientError(msg, status_code)
+        raise WikiError(msg, status_code)
 
-    # download the zip file
-    urllib.request.urlretrieve(zip_file_url, zip_file)
+    if key in data:
+        return data[key]
 
-    # unzip contents of the zip file
-    with zipfile.ZipFile(zip_file, 'r') as zfile:
-        zfile.extractall(zip_dir)
+    error = data.get('error', {})
+    code = error.get('code', 'missingtitle')
+    if code in MISSING_PAGE_CODES:
+        raise PageNotFoundError('Wikipedia page not found', status_code)
+    msg = "MediaWiki API error: " + error.get('info', code)
+    if code == 'maxlag' or code == 'ratelimited' or \
+            code.startswith('internal_api_error'):
+        raise TransientError(msg, status_code)
+    raise WikiError(msg, status_code)
 
-    # move files to correct location
-    num_added = 0
-    archive_files = os.listdir(zip_dir)
-    for json_file in archive_files:
-        ipath = join(zip_dir, json_file)
-        opath = join(stat289_json_dir, json_file)
-        if force or not os.path.exists(opath):
-            num_added += 1
-            shutil.move(ipath, opath)
 
-    msg = "Added {0:d} files from an archive of {1:d} files."
-    print(msg.format(num_added, len(archive_files)))
+def failure_report(failures):
+    """Describe the failures recorded by a bulk call.
 
-    return num_added
+    Functions such as get_wiki_json_many, build_archive and WikiCrawler
+    record the titles they could not load, together with the error raised.
+    This turns them into one row per title, so that the titles worth
+    trying again can be selected, for example with
+    report.title[report.retryable].
 
+    Args:
+        failures: Dictionary mapping titles to the raised exceptions.
 
-def links_as_list(data):
-    """Extracts MediaWiki JSON links as a list object.
+    Returns:
+        A pandas DataFrame with columns title, error (the name of the
+        exception class), message, status_code and retryable.
+    """
+    import pandas as pd
+
+    records = [failure_record(page_title, err) for page_title, err in
+               failures.items()]
+    return pd.DataFrame(records, columns=['title', 'error', 'message',
+                                          'status_code', 'retryable'])
 
-    This helper function extracts valid MediaWiki links from
-    Wikipedia and returns the data as a list.
+
+def failure_record(page_title, err):
+    """Returns a dictionary describing the failure to load one page.
 
     Args:
-        data: Data returned from the function get_wiki_json.
+        page_title: A string containing the page title.
+        err: The exception raised when loading the page.
 
     Returns:
-        A list containing the internal links on the page.
+        A dictionary with the title, the name of the exception class, its
+        message, the HTTP status code (or None) and whether trying again
+        later may succeed.
     """
-    output = []
-    for link in data['links']:
-        if link['ns'] == 0 and 'exists' in link:
-            output.append(link['*'])
+    return dict(title=page_title, error=type(err).__name__, message=str(err),
+                status_code=getattr(err, 'status_code', None),
+                retryable=is_retryable(err))
 
-    return output
+
+def is_retryable(err):
+    """Check whether an error loading a page may go away on a later try.
+
+    Args:
+        err: An exception raised while loading a page.
+
+    Returns:
+        True for transient server errors, timeouts, missed deadlines and
+        dropped connections, False otherwise.
+    """
+    if isinstance(err, WikiError):
+        return err.retryable
+    return isinstance(err, (requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout, TimeoutError))
+
+
+def async_session(limit=100):
+    """Returns a new aiohttp session using the shared HTTP settings.
+
+    The session sends the same User-Agent and uses the same timeouts as
+    the session of the blocking functions. It should be created inside a
+    coroutine and closed when done, usually with 'async with':
+
+        async with wiki.async_session() as session:
+            page = await wiki.aget_wiki_json("Plato", session=session)
+
+    Requires the aiohttp package.
+
+    Args:
+        limit: Maximum number of connections open at the same time.
+
+    Returns:
+        An aiohttp.ClientSession object.
+    """
+    import aiohttp
+
+    connect_timeout, read_timeout = _SESSION_STATE['timeout']
+    timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                    sock_read=read_timeout)
+    return aiohttp.ClientSession(
+        headers={'User-Agent': _SESSION_STATE['user_agent']},
+        timeout=timeout, connector=aiohttp.TCPConnector(limit=limit))
+
+
+async def ahttp_get(url, session=None, **kwargs):
+    """Make a GET request without blocking the event loop.
+
+    This is the asyncio counterpart of http_get: it waits on the same rate
+    limiter and follows the same retry policy. The body of
+    the response is read before it is returned, so its text and JSON can
+    be used after the connection is released. Network errors and timeouts
+    are raised as IOError.
+
+    Args:
+        url: A string giving the complete request URL.
+        session: Optional aiohttp session from async_session. If None, a
+            session is opened for this request only.
+        **kwargs: Additional arguments passed to aiohttp.ClientSession.get.
+
+    Returns:
+        An aiohttp.ClientResponse object.
+    """
+    import aiohttp
+
+    if session is None:
+        async with async_session() as session:
+            return await ahttp_get(url, session, **kwargs)
+
+    policy = _RETRY_STATE['policy']
+    for attempt in range(policy.max_attempts):
+        last_attempt = attempt == policy.max_attempts - 1
+        await _RATE_LIMITER.acquire_async()
+        try:
+            async with session.get(url, **kwargs) as resp:
+                await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            if last_attempt:
+                raise TransientError(str(err) or type(err).__name__) \
+                    from err
+            await asyncio.sleep(policy.delay(attempt))
+            continue
+
+        retry_after = _throttle_delay(resp.status, resp.headers)
+        if retry_after is None:
+            # server errors do not earn a faster rate
+            if resp.status not in policy.retry_statuses:
+                _RATE_LIMITER.success()
+            if last_attempt or not policy.should_retry(resp.status):
+                return resp
+        else:
+            _RATE_LIMITER.throttle(retry_after or None)
+            if last_attempt:
+                return resp
+
+        await asyncio.sleep(policy.delay(attempt, retry_after))
+
+    return resp
+
+
+async def adownload_wiki_json(page_title, lang='en', props=None,
+                              session=None):
+    """Download json data file Wikipedia without blocking the event loop
+    """
+    print("Pulling data from MediaWiki API: '" + page_title + "'")
+    url = get_mediawiki_request(page_title, lang, props)
+    resp = await ahttp_get(url, session)
+    if resp.status != requests.codes['ok']:
+        return check_api_response(resp.status, None)
+
+    return check_api_response(resp.status,
+                              await resp.json(content_type=None))
+
+
+async def aget_wiki_json(page_title, lang='en', props=None, session=None):
+    """Returns JSON data for a Wikipedia page without blocking the loop.
+
+    This is the asyncio counterpart of get_wiki_json and uses the same
+    cache, memory cache, rate limiter and retries. Reads and writes of
+    the cache run in worker threads, and tasks of the same event loop
+    asking for the same page share one download. A page is downloaded
+    while holding its cache lock (see alock_cache), so that threads and
+    processes sharing the cache do not download it again.
+
+    Args:
+        page_title: A string containing the page title.
+        lang: Two letter language code describing the Wikipedia
+            language used to grab the data.
+        props: Optional list of the properties needed, as in get_wiki_json.
+        session: Optional aiohttp session from async_session.
+
+    Returns:
+        A dictionary object with the parsed JSON data, as returned by
+        get_wiki_json.
+    """
+    props = _check_props(props)
+    page_data = await asyncio.to_thread(_cached_wiki_json, page_title, lang,
+                                        props)
+    if page_data is None:
+        page_data = await _arun_once(_flight_key(page_title, lang, props),
+                                     _adownload_and_store, page_title, lang,
+                                     props, session)
+
+    _queue_prefetch(page_data, lang)
+    return page_data
+
+
+async def aget_wiki_json_many(page_titles, lang='en', max_concurrency=32,
+                              failures=None, props=None, deadline=None,
+                              session=None):
+    """Yields JSON data for many Wikipedia pages, fetched as asyncio tasks.
+
+    This is the asyncio counterpart of get_wiki_json_many, to be used with
+    'async for'. Every page is a task rather than a thread, so hundreds of
+    downloads can be waiting at the same time; the shared rate limiter
+    still sets how quickly they are sent.
+
+    Args:
+        page_titles: An iterable of strings containing page titles.
+        lang: Two letter language code describing the Wikipedia
+            language used to grab the data.
+        max_concurrency: Maximum number of pages loaded at the same time.
+        failures: Optional dictionary. If given, titles that could not be
+            fetched are added as keys, with the raised exception as value.
+        props: Optional list of the properties needed, as in get_wiki_json.
+        deadline: Optional number of seconds allowed for the whole batch.
+        session: Optional aiohttp session from async_session. If None, one
+            is opened for the batch.
+
+    Yields:
+        Tuples of a page title, as given in page_titles, and the
+        dictionary that get_wiki_json returns for the page.
+    """
+    own_session = session is None
+    if own_session:
+        session = async_session()
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def load(page_title):
+        async with semaphore:
+            return await aget_wiki_json(page_title, lang, props, session)
+
+    loop = asyncio.get_running_loop()
+    end_time = None if deadline is None else loop.time() + deadline
+    tasks = {}
+    try:
+        for titles in _group_titles(page_titles):
+            tasks[asyncio.ensure_future(load(titles[0]))] = titles
+
+        unfinished = set(tasks)
+        while unfinished:
+            timeout = None if end_time is None else \
+                max(0.0, end_time - loop.time())
+            done, unfinished = await asyncio.wait(
+                unfinished, timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+
+            for task in done:
+                titles = tasks[task]
+                try:
+                    page_data = task.result()
+                except IOError as err:
+                    print("Failed to load page '" + titles[0] + "': " +
+                          str(err))
+                    if failures is not None:
+                        for page_title in titles:
+                            failures[page_title] = err
+                    continue
+
+                for page_title in titles:
+                    yield page_title, page_data
+
+        if unfinished:
+            msg = "Deadline passed with {0:d} pages unfinished."
+            print(msg.format(len(unfinished)))
+            err = TimeoutError("Deadline of {0} seconds passed".format(
+                deadline))
+            for task in unfinished:
+                if failures is not None:
+                    for page_title in tasks[task]:
+                        failures[page_title] = err
+    finally:
+        for task in tasks:
+            task.cancel()
+        if own_session:
+            await session.close()
+
+
+@contextlib.asynccontextmanager
+async def alock_cache(page_title, lang='en', cache=None):
+    """Async context manager holding the lock of a page in a cache.
+
+    This is the asyncio counterpart of the lock method of the cache
+    backends. The lock is taken by a separate pool of threads, so that
+    the event loop keeps running while another thread or process holds
+    it, and is released when the block ends.
+
+    Args:
+        page_title: A string containing the page title.
+        lang: Language code under which the page is stored.
+        cache: Cache object to lock. Defaults to the one from get_cache.
+
+    Yields:
+        A contextlib.ExitStack holding the lock. Its pop_all method hands
+        the lock over to code that releases it after the block ends.
+    """
+    if cache is None:
+        cache = get_cache()
+
+    future = _LOCK_EXECUTOR.submit(_enter_lock, cache, page_title, lang)
+    try:
+        stack = await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        # the lock may still be taken after the task has stopped waiting
+        future.add_done_callback(_close_lock)
+        raise
+
+    with stack:
+        yield stack
+
+
+def bulk_download(name, lang='en', force=False,
+                  base_url="http://distantviewing.org/", max_workers=4):
+    """Bulk download Wikipedia files
+
+    Members of the archive are read straight from the zip file into the
+    cache, without extracting them to disk first. The names already in
+    the cache are read once at the start, and members are decompressed,
+    checked against their CRC and written by a pool of threads. Corrupt
+    members are reported and skipped. The aliases listed in the archive,
+    if any, are added to the alias index of the cache.
+
+    Args:
+        name: A character string describing the name of the archive on
+            the server, or the path of a local zip file.
+        lang: Two letter language code describing the Wikipedia
+            language used to grab the data.
+        force: Boolean value. Should files be overwritten.
+        base_url: The URL path that contains the zip file.
+        max_workers: Number of threads reading and writing members.
+    Returns:
+        Number of files added to the archive.
+    """
+    if os.path.isfile(name):
+        with zipfile.ZipFile(name, 'r') as zfile:
+            return _ingest_archive(zfile, lang, force, max_workers)
+
+    # stream the zip file into an anonymous temporary file
+    zip_file_url = base_url + name + ".zip"
+    with tempfile.TemporaryFile() as zip_file:
+        with get_session().get(zip_file_url, stream=True,
+                               timeout=_SESSION_STATE['timeout']) as req:
+            if req.status_code != requests.codes['ok']:
+                raise IOError('Archive cannot be downloaded')
+            for chunk in req.iter_content(chunk_size=1 << 20):
+                zip_file.write(chunk)
+
+        zip_file.seek(0)
+        with zipfile.ZipFile(zip_file, 'r') as zfile:
+            return _ingest_archive(zfile, lang, force, max_workers)
+
+
+def build_archive(page_titles, name, lang='en', max_workers=8,
+                  deadline=None):
+    """Build a zip archive of Wikipedia pages for use with bulk_download.
+
+    Pages are fetched concurrently through get_wiki_json_many, so pages
+    already in the cache are not downloaded again. The cached file for
+    each page is written to the archive as it arrives. The files are
+    already compressed by their codec, so they are stored in the archive
+    without compressing them a second time. The requested titles, and
+    the other aliases of the pages in the cache, are written to the
+    member ARCHIVE_ALIASES, so that they find the same pages once the
+    archive has been loaded.
+
+    Args:
+        page_titles: An iterable of strings containing page titles.
+        name: Path of the archive to create, without the '.zip' suffix.
+        lang: Two letter language code describing the Wikipedia
+            language used to grab the data.
+        max_workers: Maximum number of pages to fetch at the same time.
+        deadline: Optional number of seconds allowed for fetching the
+            pages; pages not fetched in time are listed as failed.
+
+    Returns:
+        A dictionary describing the archive, with its path under 'path',
+        a list of dictionaries giving the title, file name and size in
+        bytes of each page written under 'succeeded', and a list of
+        dictionaries describing each title that could not be fetched, as
+        given by failure_record, under 'failed'.
+    """
+    cache = get_cache()
+    zip_path = name + ".zip"
+    failures = {}
+    manifest = dict(path=zip_path, succeeded=[], failed=[])
+
+    written = set()
+    aliases = {}
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zfile:
+        pages = get_wiki_json_many(page_titles, lang, max_workers, failures,
+                                   deadline=deadline)
+        for page_title, page_data in pages:
+            key = _cache_key(page_title, lang)
+            blob, codec = cache.get_raw(key, lang)
+            if blob is None:
+                # the page may still be waiting to be written
+                flush_writes()
+                key = _cache_key(page_title, lang)
+                blob, codec = cache.get_raw(key, lang)
+            if blob is None:
+                failures[page_title] = WikiError('Page missing from cache')
+                continue
+
+            file_name = wikicache.normalize_title(key) + "." + codec
+            if file_name not in written:
+                zfile.writestr(file_name, blob)
+                written.add(file_name)
+            aliases.setdefault(key, set()).add(wikicache.alias_key(page_title))
+
+            manifest['succeeded'].append(
+                dict(title=page_title, file_name=file_name, size=len(blob)))
+
+        for alias, key in cache.aliases(lang).items():
+            if key in aliases:
+                aliases[key].add(alias)
+        zfile.writestr(ARCHIVE_ALIASES, "".join(
+            alias + "\t" + key + "\n" for key in sorted(aliases)
+            for alias in sorted(aliases[key])))
+
+    for page_title, err in failures.items():
+        manifest['failed'].append(failure_record(page_title, err))
+
+    msg = "Wrote {0:d} files to '{1:s}'; {2:d} titles failed."
+    print(msg.format(len(written), zip_path, len(failures)))
+
+    return manifest
+
+
+def links_as_list(data):
+    """Extracts MediaWiki JSON links as a list object.
+
+    This helper function extracts valid MediaWiki links from
+    Wikipedia and returns the data as a list.
+
+    Args:
+        data: Data returned from the function get_wiki_json.
+
+    Returns:
+        A list containing the internal links on the page.
+    """
+    output = []
+    for link in data['links']:
+        if link['ns'] == 0 and 'exists' in link:
+            output.append(link['*'])
+
+    return output
+
+
+def _cache_key(page_title, lang, cache=None):
+    """Returns the key of the cache entry for a title.
+
+    Uses the alias index of the cache when it knows the title, and
+    otherwise the title itself.
+    """
+    if cache is None:
+        cache = get_cache()
+    key = cache.get_alias(page_title, lang)
+    if key is None:
+        return page_title
+    return key
+
+
+def _store_wiki_json(page_title, lang, page_data, props=None, cache=None,
+                     remember=False):
+    """Store downloaded page data in the cache and update the alias index.
+
+    Args:
+        page_title: The title that was requested.
+        lang: Two letter language code.
+        page_data: Dictionary returned by download_wiki_json.
+        props: List of properties for a partial entry, or None for a
+            complete page.
+        cache: Cache to write to; if None, the result of get_cache().
+        remember: Also add the page to the in-memory cache, using the size
+            of its serialized form returned by the put method of the cache.
+
+    Returns:
+        The key under which the page was stored, using the title given by
+        the API; for partial entries, the key within partial_lang(lang).
+    """
+    if cache is None:
+        cache = get_cache()
+    canonical, key = _stored_key(page_title, page_data, props)
+    part_lang = lang if props is None else wikicache.partial_lang(lang)
+    num_bytes = cache.put(key, part_lang, page_data)
+
+    cache.put_aliases(_page_titles(page_title, page_data), canonical, lang)
+    if remember and num_bytes is not None and cache is get_cache():
+        _MEMORY_CACHE.put(key, part_lang, page_data, num_bytes)
+
+    return key
+
+
+def _stored_key(page_title, page_data, props):
+    """Returns the canonical title of a downloaded page and its cache key.
+    """
+    canonical = wikicache.normalize_title(page_data.get('title', page_title))
+    if props is None:
+        return canonical, canonical
+
+    return canonical, wikicache.partial_key(canonical, props)
+
+
+def _page_titles(page_title, page_data):
+    """Returns the titles that refer to a downloaded page.
+    """
+    canonical = wikicache.normalize_title(page_data.get('title', page_title))
+    titles = [page_title, canonical]
+    titles += [x['from'] for x in page_data.get('redirects', [])]
+
+    return titles
+
+
+def _persist_wiki_json(page_title, lang, page_data, props=None,
+                       release=None, cache=None):
+    """Store a downloaded page, in the background if that is turned on.
+
+    The page is also added to the in-memory cache once it is written.
+
+    Args:
+        release: Optional function called once the page is written, or
+            has failed to be; used to release the lock of the cache.
+        cache: Cache to write to; if None, the result of get_cache().
+
+    Returns:
+        The key under which the page is stored, as for _store_wiki_json.
+    """
+    if cache is None:
+        cache = get_cache()
+    if not _WRITER.enabled():
+        try:
+            return _store_wiki_json(page_title, lang, page_data, props,
+                                    cache, remember=True)
+        finally:
+            if release is not None:
+                release()
+
+    flights = [_flight_key(x, lang, props) for x in
+               _page_titles(page_title, page_data)]
+    _WRITER.submit(flights, page_data,
+                   (page_title, lang, page_data, props, cache, True),
+                   release)
+
+    return _stored_key(page_title, page_data, props)[1]
+
+
+def _load_wiki_json(page_title, lang='en', props=None, cache=None):
+    """Loads a page as get_wiki_json does, without queueing prefetches.
+
+    The page is read from, or downloaded into, the given cache, which
+    defaults to the result of get_cache().
+    """
+    if cache is None:
+        cache = get_cache()
+    props = _check_props(props)
+    if props is not None:
+        return _get_partial_wiki_json(page_title, lang, props, cache)
+
+    key = _cache_key(page_title, lang, cache)
+    page_data = _MEMORY_CACHE.get(key, lang)
+    if page_data is not None:
+        return page_data
+
+    flight = _flight_key(page_title, lang)
+    page_data = _WRITER.pending(flight)
+    if page_data is not None:
+        return page_data
+
+    # if page does not exist, grab it from Wikipedia; other threads asking
+    # for the same page share this download rather than repeat it. A new
+    # download is returned directly, without reading it back
+    if not cache.contains(key, lang):
+        key, page_data = _IN_FLIGHT.run(flight, _fetch_wiki_json,
+                                        page_title, lang, None, True, cache)
+        if page_data is not None:
+            return page_data
+
+    # read the JSON data from the cache
+    page_data, num_bytes = cache.load(key, lang)
+    _MEMORY_CACHE.put(key, lang, page_data, num_bytes)
+
+    return page_data
+
+
+def _check_props(props):
+    """Validates a list of props; returns None if the whole page is needed.
+    """
+    if props is None:
+        return None
+
+    unknown = set(props) - set(PARSE_PROPS)
+    if unknown:
+        raise ValueError('Unknown props: ' + ', '.join(sorted(unknown)))
+    if 'text' in props:
+        return None
+
+    return props
+
+
+def _flight_key(page_title, lang, props=None):
+    """Returns the key identifying a download of a page while it runs.
+    """
+    if props is None:
+        return (lang, wikicache.alias_key(page_title))
+
+    return (wikicache.partial_lang(lang),
+            wikicache.partial_key(wikicache.alias_key(page_title), props))
+
+
+def _group_titles(page_titles):
+    """Groups titles that refer to the same page, so it is fetched once.
+    """
+    titles_by_key = {}
+    for page_title in page_titles:
+        key = wikicache.alias_key(page_title)
+        titles_by_key.setdefault(key, [])
+        if page_title not in titles_by_key[key]:
+            titles_by_key[key].append(page_title)
+
+    return list(titles_by_key.values())
+
+
+def _fetch_wiki_json(page_title, lang, props=None, write_behind=True,
+                     cache=None):
+    """Downloads a page into the cache unless it is there.
+
+    The lock of the cache makes other processes wait for this download
+    rather than repeat it. It is held until the page is written, also
+    when the write is left to a background thread.
+
+    Returns:
+        A tuple of the key of the page and, if it was downloaded or is
+        waiting to be written, its data; otherwise None.
+    """
+    if cache is None:
+        cache = get_cache()
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(cache.lock(page_title, lang))
+        key = _cache_key(page_title, lang, cache)
+        part_lang = lang
+        if props is not None:
+            key = wikicache.partial_key(key, props)
+            part_lang = wikicache.partial_lang(lang)
+
+        page_data = _WRITER.pending(_flight_key(page_title, lang, props))
+        if page_data is not None:
+            if not write_behind:
+                _WRITER.flush()
+            return key, page_data
+        if cache.contains(key, part_lang):
+            return key, None
+
+        page_data = download_wiki_json(page_title, lang, props)
+        if write_behind:
+            key = _persist_wiki_json(page_title, lang, page_data, props,
+                                     stack.pop_all().close, cache)
+        else:
+            key = _store_wiki_json(page_title, lang, page_data, props,
+                                   cache)
+
+    return key, page_data
+
+
+class _SingleFlight():
+    """Runs at most one call at a time for each key in this process.
+
+    Threads asking for a key while a call for it is running wait for that
+    call and get its result, or its exception, instead of making their own.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def run(self, key, func, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+        future.set_result(result)
+        return result
+
+    def reset(self):
+        """Forget all running calls, as in a newly forked process."""
+        self._lock = threading.Lock()
+        self._calls = {}
+
+
+# Downloads currently running, keyed by language and alias key
+_IN_FLIGHT = _SingleFlight()
+
+
+def _cached_wiki_json(page_title, lang, props):
+    """Returns the page as _load_wiki_json does if it is cached, else None.
+    """
+    page_data = _WRITER.pending(_flight_key(page_title, lang, props))
+    if page_data is not None:
+        return page_data
+
+    cache = get_cache()
+    key = _cache_key(page_title, lang)
+    if cache.contains(key, lang) or (props is not None and cache.contains(
+            wikicache.partial_key(key, props), wikicache.partial_lang(lang))):
+        return _load_wiki_json(page_title, lang, props)
+
+    return None
+
+
+async def _adownload_and_store(page_title, lang, props, session):
+    """Downloads a page under its cache lock unless it is cached.
+
+    This is the asyncio counterpart of _fetch_wiki_json, returning the
+    page data.
+    """
+    async with alock_cache(page_title, lang) as stack:
+        page_data = await asyncio.to_thread(_cached_wiki_json, page_title,
+                                            lang, props)
+        if page_data is not None:
+            return page_data
+
+        page_data = await adownload_wiki_json(page_title, lang, props,
+                                              session)
+        # the lock is held until the page is written; the write goes on
+        # if this task is cancelled
+        await asyncio.shield(asyncio.to_thread(
+            _persist_wiki_json, page_title, lang, page_data, props,
+            stack.pop_all().close))
+
+    return page_data
+
+
+def _enter_lock(cache, page_title, lang):
+    """Takes the lock of a page, returning an ExitStack that holds it.
+    """
+    stack = contextlib.ExitStack()
+    stack.enter_context(cache.lock(page_title, lang))
+    return stack
+
+
+def _close_lock(future):
+    """Releases a lock taken by _enter_lock for a task that gave up on it.
+    """
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+async def _arun_once(flight, func, *args):
+    """Runs a coroutine function once per key on the running event loop.
+
+    Tasks asking for a key while its coroutine is running wait for the
+    same result. Cancelling one of them does not cancel the shared work.
+    """
+    key = (asyncio.get_running_loop(), flight)
+    task = _ASYNC_IN_FLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(func(*args))
+        _ASYNC_IN_FLIGHT[key] = task
+
+        def forget(done_task):
+            _ASYNC_IN_FLIGHT.pop(key, None)
+            # a task left running after all of its callers gave up
+            if not done_task.cancelled():
+                done_task.exception()
+
+        task.add_done_callback(forget)
+
+    return await asyncio.shield(task)
+
+
+# Async downloads currently running, keyed by event loop and flight key
+_ASYNC_IN_FLIGHT = {}
+
+# Threads waiting for cache locks on behalf of asyncio tasks; kept apart
+# from the default executor, which the holders of the locks need in order
+# to write their pages and release them
+_LOCK_EXECUTOR = ThreadPoolExecutor(max_workers=32,
+                                    thread_name_prefix='wiki-lock')
+
+
+class _WriteBehind():
+    """Queue of downloaded pages written to the cache by background threads.
+
+    Pages are kept, under their flight keys, until they have been written,
+    so that they can be read back from pending in the meantime. Threads
+    are started on the first page submitted. Each page can come with a
+    function, called once it is written, that releases its cache lock.
+
+    Args:
+        max_queue: Maximum number of pages waiting; zero turns it off.
+        num_workers: Number of writer threads.
+    """
+    def __init__(self, max_queue=0, num_workers=2):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._queue = None
+        self._threads = []
+        self.max_queue = max_queue
+        self.num_workers = num_workers
+
+    def configure(self, max_queue, num_workers):
+        self.flush()
+        with self._lock:
+            old_queue, num_old = self._queue, len(self._threads)
+            self._queue = None
+            self._threads = []
+            self.max_queue = max_queue
+            self.num_workers = max(1, num_workers)
+
+        for _ in range(num_old):
+            old_queue.put(None)
+
+    def enabled(self):
+        return self.max_queue > 0
+
+    def submit(self, flights, page_data, args, release=None):
+        """Queue a page to be written, waiting while the queue is full.
+
+        Args:
+            flights: Flight keys under which the page can be read back.
+            page_data: Dictionary with the page data.
+            args: Arguments passed to _store_wiki_json.
+            release: Optional function called after the page is written.
+        """
+        with self._lock:
+            if self._queue is None:
+                self._queue = queue.Queue(maxsize=self.max_queue)
+                for _ in range(self.num_workers):
+                    thread = threading.Thread(target=self._work,
+                                              args=(self._queue,),
+                                              daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+            for flight in flights:
+                self._pending[flight] = page_data
+            work_queue = self._queue
+
+        try:
+            work_queue.put((flights, page_data, args, release))
+        except BaseException:
+            self._forget(flights, page_data)
+            if release is not None:
+                release()
+            raise
+
+    def pending(self, flight):
+        with self._lock:
+            return self._pending.get(flight)
+
+    def flush(self):
+        with self._lock:
+            work_queue = self._queue
+        if work_queue is not None:
+            work_queue.join()
+
+    def reset(self):
+        """Forget queued pages and threads, as in a newly forked process."""
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._queue = None
+        self._threads = []
+
+    def _forget(self, flights, page_data):
+        with self._lock:
+            for flight in flights:
+                if self._pending.get(flight) is page_data:
+                    del self._pending[flight]
+
+    def _work(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is None:
+                work_queue.task_done()
+                return
+
+            flights, page_data, args, release = item
+            try:
+                _store_wiki_json(*args)
+            except Exception as err:
+                print("Failed to write page '" + args[0] + "' to the " +
+                      "cache: " + str(err))
+            finally:
+                self._forget(flights, page_data)
+                if release is not None:
+                    release()
+                work_queue.task_done()
+
+
+# Pages waiting to be written to the cache; finished before Python exits
+_WRITER = _WriteBehind()
+atexit.register(_WRITER.flush)
+
+
+def _reset_after_fork():
+    """Drop the state a forked child process cannot share with its parent.
+
+    A child created by os.fork, for instance by a multiprocessing pool,
+    gets copies of the locks, the connections of the HTTP session and the
+    in-flight downloads and queued writes of its parent, but none of its
+    threads. The child starts over with a new session, no running
+    downloads or queued writes, and prefetching turned off.
+    """
+    global _SESSION_LOCK, _PREFETCH_LOCK, _LOCK_EXECUTOR
+
+    _SESSION_LOCK = threading.Lock()
+    _SESSION_STATE['session'] = None
+    _IN_FLIGHT.reset()
+    _ASYNC_IN_FLIGHT.clear()
+    _LOCK_EXECUTOR = ThreadPoolExecutor(max_workers=32,
+                                        thread_name_prefix='wiki-lock')
+    _WRITER.reset()
+    _RATE_LIMITER._lock = threading.Lock()
+    _PREFETCH_LOCK = threading.Lock()
+    _PREFETCH_STATE.update(queue=None, num_workers=0, num_bytes=0,
+                           num_pages=0, queued=set())
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _queue_prefetch(page_data, lang):
+    """Queue the links of a page for background download, if enabled.
+    """
+    if 'links' not in page_data:
+        return
+
+    with _PREFETCH_LOCK:
+        prefetch_queue = _PREFETCH_STATE['queue']
+        if prefetch_queue is None or \
+                _PREFETCH_STATE['num_bytes'] >= _PREFETCH_STATE['max_bytes']:
+            return
+
+        queued = _PREFETCH_STATE['queued']
+        for link in links_as_list(page_data):
+            name = (lang, wikicache.alias_key(link))
+            if name in queued:
+                continue
+            try:
+                prefetch_queue.put_nowait((link, lang))
+            except queue.Full:
+                break
+            queued.add(name)
+
+
+def _prefetch_worker(prefetch_queue):
+    """Downloads queued links into the cache until given None.
+    """
+    while True:
+        item = prefetch_queue.get()
+        if item is None:
+            return
+
+        with _PREFETCH_LOCK:
+            if prefetch_queue is not _PREFETCH_STATE['queue'] or \
+                    _PREFETCH_STATE['num_bytes'] >= \
+                    _PREFETCH_STATE['max_bytes']:
+                continue
+
+        try:
+            num_bytes = _prefetch_page(*item)
+        except IOError:
+            continue
+
+        with _PREFETCH_LOCK:
+            if prefetch_queue is _PREFETCH_STATE['queue'] and num_bytes:
+                _PREFETCH_STATE['num_bytes'] += num_bytes
+                _PREFETCH_STATE['num_pages'] += 1
+
+
+def _prefetch_page(page_title, lang):
+    """Downloads a page into the cache; returns the bytes stored.
+
+    Pages that are already cached are left alone and count as zero bytes.
+    The page is not added to the in-memory cache.
+    """
+    cache = get_cache()
+    if cache.contains(_cache_key(page_title, lang), lang):
+        return 0
+
+    flight = _flight_key(page_title, lang)
+    key, _ = _IN_FLIGHT.run(flight, _fetch_wiki_json, page_title, lang, None,
+                            False)
+
+    blob, _ = cache.get_raw(key, lang)
+    return 0 if blob is None else len(blob)
+
+
+def _get_partial_wiki_json(page_title, lang, props, cache=None):
+    """Returns the page, or only the given properties of it, from the cache.
+
+    The complete page is used if it is already cached; otherwise the
+    properties are loaded from, or downloaded into, a partial entry.
+    """
+    if cache is None:
+        cache = get_cache()
+    key = _cache_key(page_title, lang, cache)
+    page_data = _MEMORY_CACHE.get(key, lang)
+    if page_data is not None:
+        return page_data
+
+    if cache.contains(key, lang) or \
+            _WRITER.pending(_flight_key(page_title, lang)) is not None:
+        return _load_wiki_json(page_title, lang, None, cache)
+
+    key = wikicache.partial_key(key, props)
+    part_lang = wikicache.partial_lang(lang)
+    page_data = _MEMORY_CACHE.get(key, part_lang)
+    if page_data is not None:
+        return page_data
+
+    flight = _flight_key(page_title, lang, props)
+    page_data = _WRITER.pending(flight)
+    if page_data is not None:
+        return page_data
+
+    if not cache.contains(key, part_lang):
+        key, page_data = _IN_FLIGHT.run(flight, _fetch_wiki_json,
+                                        page_title, lang, props, True, cache)
+        if page_data is not None:
+            return page_data
+
+    page_data, num_bytes = cache.load(key, part_lang)
+    _MEMORY_CACHE.put(key, part_lang, page_data, num_bytes)
+
+    return page_data
+
+
+def _refresh_wiki_json(page_title, lang):
+    """Download a page again and replace it in the cache.
+    """
+    with get_cache().lock(page_title, lang):
+        page_data = download_wiki_json(page_title, lang)
+        key = _store_wiki_json(page_title, lang, page_data)
+    _MEMORY_CACHE.discard(key, lang)
+
+
+def _ingest_archive(zfile, lang, force, max_workers):
+    """Copies the members of an open zip file into the cache.
+    """
+    cache = get_cache()
+    cached_titles = set() if force else cache.keys(lang)
+
+    members = []
+    num_files = 0
+    for info in zfile.infolist():
+        if info.is_dir():
+            continue
+        page_title, codec = \
+            wikicache.parse_file_name(os.path.basename(info.filename))
+        if page_title is None:
+            continue
+        num_files += 1
+        if page_title not in cached_titles:
+            members.append((info, page_title, codec))
+
+    def copy_member(member):
+        info, page_title, codec = member
+        cache.put_raw(page_title, lang, zfile.read(info), codec)
+        # a page overwritten with force must not be served from memory
+        _MEMORY_CACHE.discard(page_title, lang)
+
+    num_added = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(copy_member, x): x for x in members}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                num_added += 1
+            except (zipfile.BadZipFile, ValueError, OSError) as err:
+                print("Skipping corrupt archive member '{0:s}': {1:s}".format(
+                    futures[future][0].filename, str(err)))
+
+    # point the titles listed in the archive at the pages
+    titles_by_key = {}
+    for info in zfile.infolist():
+        if os.path.basename(info.filename) != ARCHIVE_ALIASES:
+            continue
+        for line in zfile.read(info).decode('utf-8').split("\n"):
+            alias, _, key = line.partition("\t")
+            if key:
+                titles_by_key.setdefault(key, []).append(alias)
+    for key, titles in titles_by_key.items():
+        cache.put_aliases(titles, key, lang)
+
+    msg = "Added {0:d} files from an archive of {1:d} files."
+    print(msg.format(num_added, num_files))
+
+    return num_added
+
+
+def _query_batch(page_titles, props, lang):
+    """Run a query action for a batch of titles, following continuations.
+
+    Returns:
+        A tuple of a dictionary mapping the titles returned by the API to
+        the data for each page, and a function mapping a requested title
+        to the matching key of that dictionary.
+    """
+    base_api_url = get_api_url(lang)
+    params = dict(action='query', format='json', formatversion=2,
+                  redirects=1, maxlag=5,
+                  prop='|'.join(QUERY_PROPS[x][0] for x in props),
+                  titles='|'.join(urllib.parse.unquote(x) for x in
+                                  page_titles))
+    for prop in props:
+        if QUERY_PROPS[prop][1] is not None:
+            params[QUERY_PROPS[prop][1]] = 'max'
+
+    pages = {}
+    aliases = {}
+    while True:
+        req = http_get(base_api_url, params=params)
+        if req.status_code != requests.codes['ok']:
+            check_api_response(req.status_code, None)
+        data = req.json()
+        if 'error' in data:
+            check_api_response(req.status_code, data, 'query')
+
+        query = data.get('query', {})
+        for alias in query.get('normalized', []) + query.get('redirects', []):
+            aliases[alias['from']] = alias['to']
+        for page in query.get('pages', []):
+            if page['title'] not in pages:
+                pages[page['title']] = page
+                continue
+            # continuation responses add more items to the list props
+            for key, value in page.items():
+                if isinstance(value, list):
+                    pages[page['title']].setdefault(key, []).extend(value)
+
+        if 'continue' not in data:
+            break
+        params.update(data['continue'])
+
+    def resolve(page_title):
+        page_title = urllib.parse.unquote(page_title)
+        seen = set()
+        while page_title in aliases and page_title not in seen:
+            seen.add(page_title)
+            page_title = aliases[page_title]
+        return page_title
+
+    return pages, resolve
+
+
+def _make_session():
+    """Build a new requests.Session from the stored session settings.
+    """
+    session = requests.Session()
+    session.headers['User-Agent'] = _SESSION_STATE['user_agent']
+
+    adapter = HTTPAdapter(pool_connections=_SESSION_STATE['pool_connections'],
+                          pool_maxsize=_SESSION_STATE['pool_maxsize'])
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    for prefix, pool_size in _SESSION_STATE['host_pool_sizes'].items():
+        session.mount(prefix, HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=pool_size))
+
+    return session
+
+
+def _throttle_delay(status_code, headers):
+    """Check whether a response asks the client to slow down.
+
+    Args:
+        status_code: Integer HTTP status code of the response.
+        headers: Dictionary-like object of the response headers.
+
+    Returns:
+        None if the response was not throttled. Otherwise the number of
+        seconds given by the Retry-After header, or zero if there was none.
+    """
+    throttled = status_code in (429, 503) or \
+        headers.get('MediaWiki-API-Error') == 'maxlag'
+    if not throttled:
+        return None
+
+    retry_after = headers.get('Retry-After')
+    if retry_after is None:
+        return 0.0
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_time.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0.0
@@ -0,0 +1,1355 @@
+# -*- coding: utf-8 -*-
+"""Storage backends for cached data from the MediaWiki API.
+
+Every backend stores pages keyed by the language code and the normalized
+page title, and exposes the same small set of methods: `contains`, `get`,
+`load`, `put`, `get_raw`, `put_raw`, `remove`, `keys`, `revids`, `langs`
+and `export`. Each backend also keeps an index of aliases, mapping the
+different ways of writing a title, and the titles of redirects, to the key
+under which the page is stored (`get_alias`, `put_aliases` and `aliases`),
+and provides a `lock` method that lets threads and processes sharing the
+cache agree on which of them downloads a page. Files are always written to
+a temporary name and then renamed, so that readers never see a partially
+written entry. Raw blobs are stored together with the name of the codec
+used to encode them, such as 'json.gz' for gzip compressed JSON text, so
+that entries written with different codecs can live side by side and blobs
+can be copied between backends and zip archives without decoding. The
+MemoryCache class keeps recently used pages in memory in front of any of
+the backends.
+
+Existing caches can be converted to another backend or codec with the
+migrate function, which is also available from the command line:
+
+    python wikicache.py ../data ../data/pages.sqlite --codec json.zst
+"""
+
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+from os.path import join
+import re
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+import weakref
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+__version__ = 3
+
+# Names of the supported codecs, given as a serialization format followed
+# by an optional compression method. The names double as file extensions.
+CODECS = ('json.gz', 'json.zst', 'json.lz4', 'json',
+          'msgpack.gz', 'msgpack.zst', 'msgpack.lz4', 'msgpack')
+DEFAULT_CODEC = 'json.gz'
+
+# Directory layouts supported by FileCache
+LAYOUTS = ('flat', 'sharded')
+
+# Number of lock files used by each cache; keys are hashed onto them
+NUM_LOCK_STRIPES = 256
+
+# Library used to read and write the 'json' serialization format
+_JSON_STATE = dict(library='json')
+
+# Objects whose thread locks are replaced in forked child processes
+_FORK_HANDLERS = weakref.WeakSet()
+
+
+###############################################################################
+# Public classes and functions
+
+def normalize_title(page_title):
+    """Returns the key used to store a page title in the cache.
+
+    Args:
+        page_title: A string containing the page title.
+
+    Returns:
+        A string with spaces and slashes replaced by underscores.
+    """
+    return re.sub("[ /]", "_", page_title)
+
+
+def alias_key(page_title):
+    """Returns the form of a page title used in the alias index.
+
+    Titles that MediaWiki treats as the same page map to the same alias:
+    percent-encoding is removed, spaces and underscores are treated as
+    the same character, repeated and trailing ones are dropped, and the
+    first letter is capitalized.
+
+    Args:
+        page_title: A string containing the page title.
+
+    Returns:
+        A string such as 'Richmond,_Virginia'.
+    """
+    page_title = urllib.parse.unquote(page_title)
+    page_title = re.sub("[ _]+", "_", page_title).strip("_")
+    return normalize_title(page_title[:1].upper() + page_title[1:])
+
+
+def default_data_dir():
+    """Returns the default directory for cached data.
+
+    Returns:
+        A string giving the path of the 'data' directory found next to
+        the current working directory.
+    """
+    return join(os.path.dirname(os.getcwd()), "data")
+
+
+def set_json_library(library):
+    """Set the library used to read and write JSON data.
+
+    Both libraries produce the same format, so entries written with one
+    can be read with the other.
+
+    Args:
+        library: Either 'json' (the standard library) or 'orjson'.
+    """
+    if library not in ('json', 'orjson'):
+        raise ValueError("library must be 'json' or 'orjson'")
+    if library == 'orjson':
+        import orjson  # pylint: disable=unused-import,unused-variable
+    _JSON_STATE['library'] = library
+
+
+def atomic_write(file_path, blob):
+    """Write a file so that readers see either the old or new contents.
+
+    The data is written and flushed to disk under a temporary name in the
+    same directory, which is then renamed to the final path.
+
+    Args:
+        file_path: Path of the file to write.
+        blob: A bytes object with the contents of the file.
+    """
+    tmp_path = file_path + "." + uuid.uuid4().hex + ".tmp"
+    try:
+        with open(tmp_path, 'xb') as outfile:
+            outfile.write(blob)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def encode_page(page_data, codec=DEFAULT_CODEC):
+    """Encode page data as a blob.
+
+    Args:
+        page_data: Dictionary of page data.
+        codec: Name of the codec; one of CODECS.
+
+    Returns:
+        The encoded blob as a bytes object.
+    """
+    return _encode(page_data, codec)[0]
+
+
+def decode_page(blob, codec=DEFAULT_CODEC):
+    """Decode a blob into page data.
+
+    Args:
+        blob: A bytes object created by encode_page.
+        codec: Name of the codec used to create the blob.
+
+    Returns:
+        A tuple of the page data and the length in bytes of its
+        serialized, uncompressed form.
+    """
+    fmt, comp = _split_codec(codec)
+    data = _decompress(blob, comp)
+    return _deserialize(data, fmt), len(data)
+
+
+def partial_key(page_title, props):
+    """Returns the key used to store part of a page in the cache.
+
+    Partial pages, holding only some of the properties returned by the
+    MediaWiki API, are stored under the language given by partial_lang
+    so that they are never confused with complete pages.
+
+    Args:
+        page_title: A string containing the page title.
+        props: List of the names of the stored properties.
+
+    Returns:
+        A string with the normalized title and the sorted property names,
+        such as 'Plato#langlinks,links'.
+    """
+    return normalize_title(page_title) + "#" + ",".join(sorted(set(props)))
+
+
+def partial_lang(lang):
+    """Returns the language key used to store partial pages.
+
+    Args:
+        lang: Two letter language code.
+
+    Returns:
+        A string such as 'en-partial'.
+    """
+    return lang + "-partial"
+
+
+def parse_file_name(file_name):
+    """Split the name of a cache file into the page title and codec.
+
+    Args:
+        file_name: Base name of a file, such as 'Plato.json.gz'.
+
+    Returns:
+        A tuple of the normalized title and codec, or (None, None) if the
+        name does not end with the extension of a known codec.
+    """
+    for codec in sorted(CODECS, key=len, reverse=True):
+        if file_name.endswith("." + codec):
+            return file_name[:-(len(codec) + 1)], codec
+
+    return None, None
+
+
+def open_cache(location, codec=DEFAULT_CODEC, layout='flat'):
+    """Open a cache backend from a path.
+
+    Args:
+        location: Path of a SQLite database file, ending in '.sqlite' or
+            '.db', or of a data directory for a FileCache.
+        codec: Name of the codec used for new entries.
+        layout: Directory layout used when opening a FileCache.
+
+    Returns:
+        A SQLiteCache or FileCache object.
+    """
+    if location.endswith(".sqlite") or location.endswith(".db"):
+        return SQLiteCache(location, codec=codec)
+    return FileCache(location, codec=codec, layout=layout)
+
+
+def migrate(source, target, langs=None, max_workers=4):
+    """Copy every entry of one cache into another.
+
+    Entries are decoded to verify them and, when the target uses a
+    different codec, encoded again. Entries whose keys differ but whose
+    pages have the same normalized title, such as 'Richmond,_Virginia'
+    and 'Richmond%2C_Virginia', are only written once, under the title
+    reported by the MediaWiki API; if an entry with one of the other keys
+    already exists in the target it is removed, and the other keys are
+    added to the alias index of the target along with the aliases of
+    the source. When converting a cache in place, an entry moved to the
+    title reported by the API is removed from its old key once it has
+    been copied. Every written entry is read back from the target and
+    compared with the original.
+
+    The data directories 'en' and 'history', as written by get_wiki_json
+    and get_wikihistory_json, are both handled as languages of a
+    FileCache.
+
+    Args:
+        source: Cache object to read from.
+        target: Cache object to write to. May point to the same location
+            as source in order to convert a cache in place.
+        langs: List of languages to copy. If None, all languages found in
+            the source.
+        max_workers: Number of threads used to decode and encode entries.
+
+    Returns:
+        A dictionary describing the number of entries read, written,
+        found to be corrupt, and dropped as duplicates, together with the
+        total size of the blobs and the time taken to decode them, before
+        and after the migration.
+    """
+    if langs is None:
+        langs = source.langs()
+    in_place = _same_location(source, target)
+
+    report = dict(num_read=0, num_written=0, num_corrupt=0,
+                  num_duplicates=0, bytes_before=0, bytes_after=0,
+                  load_seconds_before=0.0, load_seconds_after=0.0,
+                  corrupt=[])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for lang in langs:
+            # first pass: verify entries and find duplicates
+            entries = {}
+            keys = sorted(source.keys(lang))
+            results = executor.map(lambda x: _inspect_entry(source, x, lang),
+                                   keys)
+            for key, result in zip(keys, results):
+                report['num_read'] += 1
+                if result is None:
+                    report['num_corrupt'] += 1
+                    report['corrupt'].append((lang, key))
+                    continue
+                canonical, revid, num_bytes, seconds = result
+                report['bytes_before'] += num_bytes
+                report['load_seconds_before'] += seconds
+                entries.setdefault(canonical, []).append((key, revid))
+
+            # second pass: write one entry for each page
+            winners = []
+            renamed = {}
+            for canonical, candidates in entries.items():
+                key = _choose_duplicate(canonical, candidates)
+                winners.append((key, canonical))
+                for other, _ in candidates:
+                    renamed[other] = canonical
+                    if other == key:
+                        continue
+                    report['num_duplicates'] += 1
+                    if other != canonical and target.contains(other, lang):
+                        target.remove(other, lang)
+
+            results = executor.map(
+                lambda x: _copy_entry(source, target, x[0], x[1], lang),
+                winners)
+            for (key, canonical), result in zip(winners, results):
+                if result is None:
+                    report['num_corrupt'] += 1
+                    report['corrupt'].append((lang, key))
+                    continue
+                if in_place and key != canonical:
+                    source.remove(key, lang)
+                num_bytes, seconds = result
+                report['num_written'] += 1
+                report['bytes_after'] += num_bytes
+                report['load_seconds_after'] += seconds
+
+            # carry over the alias index, pointing at the new keys
+            aliases = {}
+            for alias, key in source.aliases(lang).items():
+                aliases.setdefault(renamed.get(key, key), []).append(alias)
+            for key, canonical in renamed.items():
+                if key != canonical:
+                    aliases.setdefault(canonical, []).append(key)
+            for canonical, titles in aliases.items():
+                target.put_aliases(titles, canonical, lang)
+
+    if hasattr(target, 'compact'):
+        target.compact()
+
+    return report
+
+
+class FileCache():
+    """Page cache storing each page as its own file.
+
+    With the default 'flat' layout, the page 'Plato' in English is stored
+    at 'data/en/Plato.json.gz'. With the 'sharded' layout, files are
+    spread over two levels of sub-directories named from the MD5 hash of
+    the title, such as 'data/en/3f/a2/Plato.json.gz', which keeps every
+    directory small for very large caches. A sharded cache still finds
+    and reads files left in the flat layout, and moves them when they are
+    written again. The codec of each entry is given by its file
+    extension, so files written with other codecs are also found.
+
+    Args:
+        base_dir: Directory with one sub-directory per language. If None,
+            the result of default_data_dir() at the time of each call.
+        codec: Name of the codec used for new entries; one of CODECS.
+        layout: Either 'flat' or 'sharded'.
+    """
+    def __init__(self, base_dir=None, codec=DEFAULT_CODEC, layout='flat'):
+        _split_codec(codec)
+        if layout not in LAYOUTS:
+            raise ValueError("layout must be 'flat' or 'sharded'")
+        self.base_dir = base_dir
+        self.codec = codec
+        self.layout = layout
+        self._alias_lock = threading.Lock()
+        self._alias_state = {}
+        self._locks = _StripedLock(lambda: join(self._base_dir(), ".locks"))
+        _FORK_HANDLERS.add(self)
+
+    def _after_fork(self):
+        self._alias_lock = threading.Lock()
+
+    def __str__(self):
+        return "FileCache object stored in '{0:s}'.".format(self._base_dir())
+
+    def path(self, page_title, lang='en', codec=None):
+        """Returns the path where the file for a page is written.
+
+        The directory for the file is created if it does not exist.
+
+        Args:
+            page_title: A string containing the page title.
+            lang: Two letter language code.
+            codec: Codec giving the file extension. If None, the codec
+                used for new entries.
+
+        Returns:
+            A string describing a path to the file.
+        """
+        if codec is None:
+            codec = self.codec
+
+        dir_name = self._entry_dir(page_title, lang, self.layout)
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name, exist_ok=True)
+
+        return join(dir_name, normalize_title(page_title) + "." + codec)
+
+    def locate(self, page_title, lang='en'):
+        """Returns the path of the stored file for a page, or None.
+        """
+        return self._find(page_title, lang)[0]
+
+    def contains(self, page_title, lang='en'):
+        """Check whether a page is in the cache.
+        """
+        return self._find(page_title, lang)[0] is not None
+
+    def get(self, page_title, lang='en'):
+        """Returns the cached data for a page, or None if not cached.
+        """
+        return self.load(page_title, lang)[0]
+
+    def load(self, page_title, lang='en'):
+        """Returns the cached data for a page and its size when decoded.
+
+        Returns:
+            A tuple of the page data and the length in bytes of its
+            serialized form, or (None, 0) if the page is not cached.
+        """
+        blob, codec = self.get_raw(page_title, lang)
+        if blob is None:
+            return None, 0
+        return decode_page(blob, codec)
+
+    def put(self, page_title, lang, page_data):
+        """Store the data for a page.
+
+        Returns:
+            The length in bytes of the serialized form of the page, as
+            given by load.
+        """
+        blob, num_bytes = _encode(page_data, self.codec)
+        self.put_raw(page_title, lang, blob, self.codec)
+        return num_bytes
+
+    def get_raw(self, page_title, lang='en'):
+        """Returns the blob for a page and the name of its codec.
+
+        Returns:
+            A tuple of the blob and codec, or (None, None) if the page is
+            not cached.
+        """
+        file_path, codec = self._find(page_title, lang)
+        if file_path is None:
+            return None, None
+        try:
+            with open(file_path, 'rb') as infile:
+                return infile.read(), codec
+        except FileNotFoundError:
+            return None, None
+
+    def put_raw(self, page_title, lang, blob, codec=DEFAULT_CODEC):
+        """Store the blob for a page, encoded with the given codec.
+
+        Any copy of the page stored with a different codec is removed.
+        """
+        _split_codec(codec)
+        file_path = self.path(page_title, lang, codec)
+        atomic_write(file_path, blob)
+
+        for other_path, _ in self._candidates(page_title, lang):
+            if other_path != file_path:
+                try:
+                    os.remove(other_path)
+                except FileNotFoundError:
+                    pass
+
+    def keys(self, lang='en'):
+        """Returns a set of the normalized titles cached for a language.
+        """
+        dir_name = self._lang_dir(lang)
+        if not os.path.exists(dir_name):
+            return set()
+
+        output = set()
+        for entry in os.scandir(dir_name):
+            if entry.is_dir() and self.layout == 'sharded':
+                for sub_entry in os.scandir(entry.path):
+                    if sub_entry.is_dir():
+                        output.update(_scan_keys(sub_entry.path))
+            elif not entry.is_dir():
+                page_title = parse_file_name(entry.name)[0]
+                if page_title is not None:
+                    output.add(page_title)
+
+        return output
+
+    def revids(self, lang='en', max_workers=4):
+        """Returns a dictionary mapping cached keys to a title and revid.
+
+        Each value is a tuple of the title reported by the MediaWiki API,
+        which unlike the key can be passed back to the API, and the revid.
+        Both are kept in the file '_revids.tsv' of each language directory
+        together with the size and modification time of each entry, so
+        that only entries written since the last call are read, by a pool
+        of max_workers threads, and decoded. Entries that cannot be
+        decoded are skipped.
+        """
+        index_path = join(self._lang_dir(lang), "_revids.tsv")
+        index = _read_revid_index(index_path)
+
+        output = {}
+        stamps = {}
+        stale = []
+        for page_title in self.keys(lang):
+            try:
+                stat = os.stat(self._find(page_title, lang)[0])
+            except (TypeError, FileNotFoundError):
+                continue
+            stamps[page_title] = (stat.st_size, stat.st_mtime_ns)
+            if page_title in index and \
+                    index[page_title][0] == stamps[page_title]:
+                output[page_title] = index[page_title][1]
+            else:
+                stale.append(page_title)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            values = executor.map(lambda x: _read_revid(self, x, lang), stale)
+            for page_title, value in zip(stale, values):
+                if value is not None:
+                    output[page_title] = value
+
+        if stale or len(index) != len(output):
+            lines = []
+            for key, (title, revid) in sorted(output.items()):
+                size, mtime = stamps[key]
+                lines.append("\t".join([
+                    key, str(size), str(mtime),
+                    "" if revid is None else str(revid), title]) + "\n")
+            atomic_write(index_path, "".join(lines).encode('utf-8'))
+
+        return output
+
+    def remove(self, page_title, lang='en'):
+        """Remove a page from the cache if it is stored.
+        """
+        for file_path, _ in self._candidates(page_title, lang):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    def lock(self, page_title, lang='en'):
+        """Returns a context manager holding the lock for a page.
+
+        The lock is shared with other threads and with other processes
+        using the same data directory.
+        """
+        return self._locks.lock(lang + "/" + alias_key(page_title))
+
+    def get_alias(self, page_title, lang='en'):
+        """Returns the key of the entry stored for a title, or None.
+
+        The alias index is kept in the file '_aliases.tsv' of each
+        language directory and read into memory when first needed. Lines
+        appended later, also by other processes, are read from where the
+        last read stopped.
+        """
+        alias = alias_key(page_title)
+        with self._alias_lock:
+            aliases = self._load_aliases(lang)
+            if alias not in aliases:
+                # another process may have added the alias since
+                aliases = self._load_aliases(lang, reload=True)
+            return aliases.get(alias)
+
+    def put_aliases(self, page_titles, key, lang='en'):
+        """Record that each of the titles refers to the entry key.
+        """
+        key = normalize_title(key)
+        with self._alias_lock:
+            aliases = self._load_aliases(lang, reload=True)
+            lines = []
+            for alias in set(alias_key(x) for x in page_titles):
+                if aliases.get(alias) != key:
+                    aliases[alias] = key
+                    lines.append(alias + "\t" + key + "\n")
+            if lines:
+                file_path = self._alias_path(lang)
+                # the offset is left before these lines, which are read
+                # again on the next reload along with any written by
+                # other processes in the meantime
+                with open(file_path, 'a', encoding='UTF-8') as outfile:
+                    outfile.write("".join(lines))
+
+    def aliases(self, lang='en'):
+        """Returns a dictionary mapping each alias to its entry key.
+        """
+        with self._alias_lock:
+            return dict(self._load_aliases(lang, reload=True))
+
+    def langs(self):
+        """Returns a list of the languages with a directory in the cache.
+        """
+        base_dir = self._base_dir()
+        if not os.path.exists(base_dir):
+            return []
+
+        return sorted(x for x in os.listdir(base_dir)
+                      if os.path.isdir(join(base_dir, x)) and
+                      not x.startswith("."))
+
+    def export(self, lang='en'):
+        """Yields a tuple of the title, blob and codec of every cached page.
+        """
+        for page_title in sorted(self.keys(lang)):
+            blob, codec = self.get_raw(page_title, lang)
+            if blob is not None:
+                yield page_title, blob, codec
+
+    def _find(self, page_title, lang):
+        """Returns the path and codec of the stored file for a page.
+        """
+        for file_path, codec in self._candidates(page_title, lang):
+            if os.path.exists(file_path):
+                return file_path, codec
+
+        return None, None
+
+    def _candidates(self, page_title, lang):
+        """Returns the paths and codecs where a page may be stored.
+
+        Paths in the layout of the cache come before those in the flat
+        layout, and the codec for new entries before the others.
+        """
+        layouts = [self.layout]
+        if self.layout != 'flat':
+            layouts.append('flat')
+        codecs = (self.codec,) + tuple(x for x in CODECS if x != self.codec)
+
+        output = []
+        for layout in layouts:
+            base_path = join(self._entry_dir(page_title, lang, layout),
+                             normalize_title(page_title))
+            output.extend((base_path + "." + x, x) for x in codecs)
+
+        return output
+
+    def _entry_dir(self, page_title, lang, layout):
+        if layout == 'flat':
+            return self._lang_dir(lang)
+
+        digest = hashlib.md5(normalize_title(page_title).encode('utf-8'))
+        digest = digest.hexdigest()
+        return join(self._lang_dir(lang), digest[:2], digest[2:4])
+
+    def _alias_path(self, lang):
+        dir_name = self._lang_dir(lang)
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        return join(dir_name, "_aliases.tsv")
+
+    def _load_aliases(self, lang, reload=False):
+        """Returns the alias index of a language, reading it if needed.
+
+        Only the complete lines added since the last read are parsed; a
+        line still being written is left for the next reload. Must be
+        called while holding the alias lock.
+        """
+        file_path = self._alias_path(lang)
+        offset, aliases = self._alias_state.get(file_path, (-1, {}))
+        if offset >= 0 and not reload:
+            return aliases
+
+        try:
+            size = os.path.getsize(file_path)
+        except FileNotFoundError:
+            size = 0
+        if size < offset:
+            # the index was removed or replaced; read it from the start
+            offset, aliases = -1, {}
+        offset = max(offset, 0)
+
+        if size > offset:
+            with open(file_path, 'rb') as infile:
+                infile.seek(offset)
+                data = infile.read(size - offset)
+            data = data[:data.rfind(b"\n") + 1]
+            offset += len(data)
+            for line in data.decode('utf-8').split("\n"):
+                alias, _, key = line.partition("\t")
+                if key:
+                    aliases[alias] = key
+        self._alias_state[file_path] = (offset, aliases)
+
+        return aliases
+
+    def _base_dir(self):
+        if self.base_dir is None:
+            return default_data_dir()
+        return self.base_dir
+
+    def _lang_dir(self, lang):
+        return join(self._base_dir(), lang)
+
+
+class SQLiteCache():
+    """Page cache storing all pages in a single SQLite database.
+
+    Pages are stored in one table with a primary key of the language and
+    normalized title, the pageid, revid and title reported by the API of
+    the page, the encoded data and the name of the codec used to encode
+    it. Each thread uses its own connection to the file.
+
+    Args:
+        path: Path of the database file. If None, 'pages.sqlite' inside
+            the result of default_data_dir().
+        codec: Name of the codec used for new entries; one of CODECS.
+    """
+    def __init__(self, path=None, codec=DEFAULT_CODEC):
+        _split_codec(codec)
+        if path is None:
+            path = join(default_data_dir(), "pages.sqlite")
+        self.path = path
+        self.codec = codec
+        self._local = threading.local()
+        self._locks = _StripedLock(lambda: self.path + ".locks")
+        _FORK_HANDLERS.add(self)
+
+        dir_name = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS pages ("
+                         "lang TEXT NOT NULL, title TEXT NOT NULL, "
+                         "pageid INTEGER, revid INTEGER, "
+                         "data BLOB NOT NULL, PRIMARY KEY (lang, title))")
+            conn.execute("CREATE INDEX IF NOT EXISTS pages_pageid "
+                         "ON pages (lang, pageid)")
+            conn.execute("CREATE TABLE IF NOT EXISTS aliases ("
+                         "lang TEXT NOT NULL, alias TEXT NOT NULL, "
+                         "title TEXT NOT NULL, PRIMARY KEY (lang, alias))")
+
+            # databases created before codecs were recorded are all gzip
+            columns = [x[1] for x in conn.execute("PRAGMA table_info(pages)")]
+            if 'codec' not in columns:
+                conn.execute("ALTER TABLE pages ADD COLUMN codec TEXT "
+                             "NOT NULL DEFAULT '" + DEFAULT_CODEC + "'")
+            # and before titles were; revids reads them from the data
+            if 'api_title' not in columns:
+                conn.execute("ALTER TABLE pages ADD COLUMN api_title TEXT")
+
+    def __str__(self):
+        return "SQLiteCache object stored in '{0:s}'.".format(self.path)
+
+    def contains(self, page_title, lang='en'):
+        """Check whether a page is in the cache.
+        """
+        cur = self._connect().execute(
+            "SELECT 1 FROM pages WHERE lang = ? AND title = ?",
+            (lang, normalize_title(page_title)))
+        return cur.fetchone() is not None
+
+    def get(self, page_title, lang='en'):
+        """Returns the cached data for a page, or None if not cached.
+        """
+        return self.load(page_title, lang)[0]
+
+    def load(self, page_title, lang='en'):
+        """Returns the cached data for a page and its size when decoded.
+
+        Returns:
+            A tuple of the page data and the length in bytes of its
+            serialized form, or (None, 0) if the page is not cached.
+        """
+        blob, codec = self.get_raw(page_title, lang)
+        if blob is None:
+            return None, 0
+        return decode_page(blob, codec)
+
+    def put(self, page_title, lang, page_data):
+        """Store the data for a page.
+
+        Returns:
+            The length in bytes of the serialized form of the page, as
+            given by load.
+        """
+        blob, num_bytes = _encode(page_data, self.codec)
+        self.put_raw(page_title, lang, blob, self.codec,
+                     page_data.get('pageid'), page_data.get('revid'),
+                     page_data.get('title'))
+        return num_bytes
+
+    def get_raw(self, page_title, lang='en'):
+        """Returns the blob for a page and the name of its codec.
+
+        Returns:
+            A tuple of the blob and codec, or (None, None) if the page is
+            not cached.
+        """
+        cur = self._connect().execute(
+            "SELECT data, codec FROM pages WHERE lang = ? AND title = ?",
+            (lang, normalize_title(page_title)))
+        row = cur.fetchone()
+        if row is None:
+            return None, None
+        return bytes(row[0]), row[1]
+
+    def put_raw(self, page_title, lang, blob, codec=DEFAULT_CODEC,
+                pageid=None, revid=None, title=None):
+        """Store the blob for a page, encoded with the given codec.
+
+        If none of pageid, revid and title are given, they are read from
+        the blob.
+        """
+        if pageid is None and revid is None and title is None:
+            page_data = decode_page(blob, codec)[0]
+            pageid = page_data.get('pageid')
+            revid = page_data.get('revid')
+            title = page_data.get('title')
+
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO pages "
+                         "(lang, title, pageid, revid, data, codec, "
+                         "api_title) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (lang, normalize_title(page_title), pageid, revid,
+                          sqlite3.Binary(blob), codec, title))
+
+    def keys(self, lang='en'):
+        """Returns a set of the normalized titles cached for a language.
+        """
+        cur = self._connect().execute(
+            "SELECT title FROM pages WHERE lang = ?", (lang,))
+        return set(row[0] for row in cur)
+
+    def revids(self, lang='en'):
+        """Returns a dictionary mapping cached keys to a title and revid.
+
+        Each value is a tuple of the title reported by the MediaWiki API,
+        which unlike the key can be passed back to the API, and the revid.
+        Titles missing from rows written by older versions are read from
+        the data and stored.
+        """
+        cur = self._connect().execute(
+            "SELECT title, api_title, revid FROM pages WHERE lang = ?",
+            (lang,))
+        output = dict((row[0], (row[1], row[2])) for row in cur)
+
+        for key in [k for k, v in output.items() if v[0] is None]:
+            try:
+                page_data = self.get(key, lang)
+            except Exception:  # pylint: disable=broad-except
+                page_data = None
+            title = key
+            if isinstance(page_data, dict):
+                title = page_data.get('title', key)
+            output[key] = (title, output[key][1])
+            with self._connect() as conn:
+                conn.execute("UPDATE pages SET api_title = ? WHERE "
+                             "lang = ? AND title = ?", (title, lang, key))
+
+        return output
+
+    def remove(self, page_title, lang='en'):
+        """Remove a page from the cache if it is stored.
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM pages WHERE lang = ? AND title = ?",
+                         (lang, normalize_title(page_title)))
+
+    def lock(self, page_title, lang='en'):
+        """Returns a context manager holding the lock for a page.
+
+        The lock is shared with other threads and with other processes
+        using the same database file.
+        """
+        return self._locks.lock(lang + "/" + alias_key(page_title))
+
+    def get_alias(self, page_title, lang='en'):
+        """Returns the key of the entry stored for a title, or None.
+        """
+        cur = self._connect().execute(
+            "SELECT title FROM aliases WHERE lang = ? AND alias = ?",
+            (lang, alias_key(page_title)))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put_aliases(self, page_titles, key, lang='en'):
+        """Record that each of the titles refers to the entry key.
+        """
+        rows = [(lang, x, normalize_title(key)) for x in
+                set(alias_key(x) for x in page_titles)]
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO aliases "
+                             "(lang, alias, title) VALUES (?, ?, ?)", rows)
+
+    def aliases(self, lang='en'):
+        """Returns a dictionary mapping each alias to its entry key.
+        """
+        cur = self._connect().execute(
+            "SELECT alias, title FROM aliases WHERE lang = ?", (lang,))
+        return dict((row[0], row[1]) for row in cur)
+
+    def langs(self):
+        """Returns a list of the languages with pages in the cache.
+        """
+        cur = self._connect().execute(
+            "SELECT DISTINCT lang FROM pages ORDER BY lang")
+        return [row[0] for row in cur]
+
+    def compact(self):
+        """Rebuild the database file to reclaim unused space.
+        """
+        self._connect().execute("VACUUM")
+
+    def export(self, lang='en'):
+        """Yields a tuple of the title, blob and codec of every cached page.
+        """
+        cur = self._connect().execute(
+            "SELECT title, data, codec FROM pages WHERE lang = ? "
+            "ORDER BY title", (lang,))
+        for row in cur:
+            yield row[0], bytes(row[1]), row[2]
+
+    def close(self):
+        """Close the connection used by the current thread.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _after_fork(self):
+        # connections opened by the parent must not be used in the child
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+
+class MemoryCache():
+    """Least recently used cache of decoded pages held in memory.
+
+    The cache is bounded by the total size of the serialized pages it
+    holds rather than by the number of pages. Pages are returned as
+    the same dictionary objects that were stored, so callers should treat
+    them as read-only.
+
+    Args:
+        max_bytes: Maximum total size, in serialized bytes, of the pages
+            held. Set to zero to disable the cache.
+    """
+    def __init__(self, max_bytes=128 * 2**20):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.num_bytes = 0
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+        _FORK_HANDLERS.add(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        msg = "MemoryCache object with '{0:d}' pages using {1:d} of {2:d} " \
+              "bytes."
+        return msg.format(len(self._pages), self.num_bytes, self.max_bytes)
+
+    def get(self, page_title, lang='en'):
+        """Returns the data for a page, or None if it is not held.
+        """
+        key = (lang, normalize_title(page_title))
+        with self._lock:
+            if key not in self._pages:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._pages.move_to_end(key)
+            return self._pages[key][0]
+
+    def put(self, page_title, lang, page_data, num_bytes):
+        """Store the data for a page, evicting older pages if needed.
+
+        Args:
+            page_title: A string containing the page title.
+            lang: Two letter language code.
+            page_data: Dictionary of page data.
+            num_bytes: Size of the page, in serialized bytes.
+        """
+        key = (lang, normalize_title(page_title))
+        with self._lock:
+            if key in self._pages:
+                self.num_bytes -= self._pages.pop(key)[1]
+            if num_bytes > self.max_bytes:
+                return
+
+            self._pages[key] = (page_data, num_bytes)
+            self.num_bytes += num_bytes
+            while self.num_bytes > self.max_bytes:
+                self.num_bytes -= self._pages.popitem(last=False)[1][1]
+
+    def discard(self, page_title, lang='en'):
+        """Remove a page from the cache if it is held.
+        """
+        key = (lang, normalize_title(page_title))
+        with self._lock:
+            if key in self._pages:
+                self.num_bytes -= self._pages.pop(key)[1]
+
+    def resize(self, max_bytes):
+        """Change the maximum size, evicting pages if needed.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.num_bytes > self.max_bytes:
+                self.num_bytes -= self._pages.popitem(last=False)[1][1]
+
+    def clear(self):
+        """Remove all pages and reset the hit and miss counters.
+        """
+        with self._lock:
+            self._pages.clear()
+            self.num_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Returns a dictionary of statistics about the cache.
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        pages=len(self._pages), num_bytes=self.num_bytes,
+                        max_bytes=self.max_bytes)
+
+
+###############################################################################
+# Private functions
+
+class _StripedLock():
+    """Locks shared by threads and processes, hashed from string keys.
+
+    Each key maps onto one of NUM_LOCK_STRIPES stripes. A stripe is held
+    by taking a thread lock and then an exclusive lock on a file in the
+    lock directory, so that the number of lock files stays bounded.
+
+    Args:
+        lock_dir: Function returning the path of the lock directory.
+    """
+    def __init__(self, lock_dir):
+        self._lock_dir = lock_dir
+        self._thread_locks = [threading.Lock() for _ in
+                              range(NUM_LOCK_STRIPES)]
+        _FORK_HANDLERS.add(self)
+
+    def _after_fork(self):
+        self._thread_locks = [threading.Lock() for _ in
+                              range(NUM_LOCK_STRIPES)]
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Context manager holding the lock for a key.
+        """
+        stripe = zlib.crc32(key.encode('utf-8')) % NUM_LOCK_STRIPES
+        lock_dir = self._lock_dir()
+        if not os.path.exists(lock_dir):
+            os.makedirs(lock_dir, exist_ok=True)
+
+        lock_path = join(lock_dir, "{0:03d}.lock".format(stripe))
+        with self._thread_locks[stripe]:
+            with open(lock_path, 'a+b') as lock_file:
+                _lock_file(lock_file)
+                try:
+                    yield
+                finally:
+                    _unlock_file(lock_file)
+
+
+def _reset_after_fork():
+    """Give a forked child process new thread locks and connections.
+
+    The child gets copies of the thread locks of its parent, possibly held
+    by threads that do not exist in the child, and of its open SQLite
+    connections, which must not be used from two processes.
+    """
+    for obj in list(_FORK_HANDLERS):
+        obj._after_fork()  # pylint: disable=protected-access
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _lock_file(lock_file):
+    """Take an exclusive lock on an open file, waiting until it is free.
+    """
+    if os.name == 'nt':
+        import msvcrt
+        lock_file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock_file(lock_file):
+    if os.name == 'nt':
+        import msvcrt
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _read_revid_index(index_path):
+    """Returns the revid index of FileCache.revids, keyed by entry key.
+
+    Each value is a tuple of the size and modification time of the entry
+    when it was read, and of its title and revid.
+    """
+    index = {}
+    try:
+        with open(index_path, 'r', encoding='UTF-8') as infile:
+            for line in infile:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) != 5:
+                    continue
+                key, size, mtime, revid, title = fields
+                index[key] = ((int(size), int(mtime)),
+                              (title, int(revid) if revid else None))
+    except (FileNotFoundError, ValueError):
+        pass
+
+    return index
+
+
+def _read_revid(cache, key, lang):
+    """Returns the title and revid stored in an entry, or None.
+    """
+    try:
+        page_data = cache.get(key, lang)
+    except Exception:  # pylint: disable=broad-except
+        return None
+    if not isinstance(page_data, dict):
+        return None
+
+    return page_data.get('title', key), page_data.get('revid')
+
+
+def _scan_keys(dir_name):
+    """Returns the titles of the cache files in a directory.
+    """
+    output = set()
+    for entry in os.scandir(dir_name):
+        page_title = parse_file_name(entry.name)[0]
+        if page_title is not None:
+            output.add(page_title)
+
+    return output
+
+
+def _same_location(source, target):
+    """Check whether two cache objects store their entries in one place.
+    """
+    if source is target:
+        return True
+    if type(source) is not type(target):
+        return False
+    if isinstance(source, FileCache):
+        # pylint: disable=protected-access
+        paths = (source._base_dir(), target._base_dir())
+    else:
+        paths = (getattr(source, 'path', None), getattr(target, 'path', None))
+    if None in paths:
+        return False
+
+    return os.path.realpath(paths[0]) == os.path.realpath(paths[1])
+
+
+def _inspect_entry(source, key, lang):
+    """Decode an entry, returning its title, revid, size and decode time.
+    """
+    try:
+        blob, codec = source.get_raw(key, lang)
+        start = time.perf_counter()
+        page_data = decode_page(blob, codec)[0]
+        seconds = time.perf_counter() - start
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+    canonical, revid = key, 0
+    if isinstance(page_data, dict):
+        if 'title' in page_data:
+            _, sep, props = key.partition("#")
+            canonical = normalize_title(page_data['title']) + sep + props
+        revid = page_data.get('revid') or 0
+
+    return canonical, revid, len(blob), seconds
+
+
+def _choose_duplicate(canonical, candidates):
+    """Pick the key to keep from entries describing the same page.
+
+    The entry stored under the canonical title wins; otherwise the one
+    with the latest revision.
+    """
+    for key, _ in candidates:
+        if key == canonical:
+            return key
+    return max(candidates, key=lambda x: x[1])[0]
+
+
+def _copy_entry(source, target, key, canonical, lang):
+    """Copy an entry to the target and verify it by reading it back.
+    """
+    try:
+        blob, codec = source.get_raw(key, lang)
+        page_data = decode_page(blob, codec)[0]
+
+        target_codec = getattr(target, 'codec', DEFAULT_CODEC)
+        if codec != target_codec:
+            blob, codec = encode_page(page_data, target_codec), target_codec
+        target.put_raw(canonical, lang, blob, codec)
+
+        new_blob, new_codec = target.get_raw(canonical, lang)
+        start = time.perf_counter()
+        new_data = decode_page(new_blob, new_codec)[0]
+        seconds = time.perf_counter() - start
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+    if new_data != page_data:
+        return None
+
+    return len(new_blob), seconds
+
+
+def _encode(page_data, codec):
+    """Returns the blob for page data and the length of its serialized form.
+    """
+    fmt, comp = _split_codec(codec)
+    data = _serialize(page_data, fmt)
+    return _compress(data, comp), len(data)
+
+
+def _split_codec(codec):
+    """Split a codec name into the serialization format and compression.
+    """
+    if codec not in CODECS:
+        raise ValueError("Unknown codec '{0:s}'; use one of {1:s}".format(
+            codec, ", ".join(CODECS)))
+    fmt, _, comp = codec.partition('.')
+    return fmt, comp
+
+
+def _serialize(page_data, fmt):
+    if fmt == 'msgpack':
+        import msgpack
+        return msgpack.packb(page_data, use_bin_type=True)
+    if _JSON_STATE['library'] == 'orjson':
+        import orjson
+        return orjson.dumps(page_data)
+    return json.dumps(page_data).encode('utf-8')
+
+
+def _deserialize(data, fmt):
+    if fmt == 'msgpack':
+        import msgpack
+        return msgpack.unpackb(data, raw=False)
+    if _JSON_STATE['library'] == 'orjson':
+        import orjson
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def _compress(data, comp):
+    if comp == 'gz':
+        return gzip.compress(data, compresslevel=6)
+    if comp == 'zst':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    if comp == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(data)
+    return data
+
+
+def _decompress(blob, comp):
+    if comp == 'gz':
+        return gzip.decompress(blob)
+    if comp == 'zst':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(blob)
+    if comp == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(blob)
+    return blob
+
+
+def main(argv=None):
+    """Command line interface to migrate.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Convert a cache of MediaWiki API data to another "
+                    "backend or codec.")
+    parser.add_argument("source", help="data directory or SQLite file")
+    parser.add_argument("target", help="data directory or SQLite file")
+    parser.add_argument("--codec", default=DEFAULT_CODEC, choices=CODECS,
+                        help="codec used for entries in the target")
+    parser.add_argument("--layout", default="flat", choices=LAYOUTS,
+                        help="directory layout of a target data directory")
+    parser.add_argument("--lang", action="append", dest="langs",
+                        help="language to copy; may be repeated (default: "
+                             "all)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of worker threads")
+    args = parser.parse_args(argv)
+
+    source = open_cache(args.source)
+    target = open_cache(args.target, codec=args.codec, layout=args.layout)
+    report = migrate(source, target, langs=args.langs,
+                     max_workers=args.workers)
+
+    msg = "Read {0:d} entries and wrote {1:d} ({2:d} corrupt, {3:d} " \
+          "duplicates)."
+    print(msg.format(report['num_read'], report['num_written'],
+                     report['num_corrupt'], report['num_duplicates']))
+    msg = "Size: {0:.1f} MB -> {1:.1f} MB. Load time: {2:.2f}s -> {3:.2f}s."
+    print(msg.format(report['bytes_before'] / 2**20,
+                     report['bytes_after'] / 2**20,
+                     report['load_seconds_before'],
+                     report['load_seconds_after']))
+    for lang, key in report['corrupt']:
+        print("Corrupt entry: " + lang + "/" + key)
+
+    return 0 if report['num_corrupt'] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
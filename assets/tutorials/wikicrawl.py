@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""Module for building collections of Wikipedia pages by following links.
+
+A crawl starts from a list of seed pages and follows their internal links,
+breadth first or in order of a priority score, up to a maximum depth or
+number of pages. Pages are fetched concurrently through
+wiki.get_wiki_json_many, so they end up in the shared cache and pages that
+are already cached are not downloaded again. The state of the crawl can be
+saved to a checkpoint file, from which a long crawl picks up again after
+it has been interrupted:
+
+    crawler = WikiCrawler(["Impressionism"], max_depth=2, max_pages=5000,
+                          checkpoint="impressionism-crawl.json.gz")
+    links = crawler.run()
+"""
+
+import array
+import base64
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import os
+
+import wiki
+import wikicache
+import wikitext
+
+__version__ = 2
+
+# Names of the built-in priority scores for WikiCrawler
+PRIORITIES = ('inlinks', 'similarity')
+
+
+###############################################################################
+# Public classes and functions
+
+class WikiCrawler():
+    """Crawler over the internal links of Wikipedia pages.
+
+    Titles are deduplicated using a set of 64-bit hashes of their alias
+    keys (see wikicache.alias_key), which takes much less memory than the
+    titles themselves and treats different ways of writing a title as the
+    same page. Titles that could not be loaded are kept in the failures
+    attribute, which maps each of them to a dictionary describing the
+    error, as given by wiki.failure_record.
+
+    By default pages are fetched breadth first. When a priority is given,
+    the frontier is kept in a heap and the pages with the highest scores
+    are fetched first, so that a crawl stopped by max_pages still holds
+    the most central pages of the collection. The built-in scores are
+    'inlinks', the number of links to a page seen so far, and
+    'similarity', the Jaccard similarity between the links of the page
+    linking to it and the links of the seeds. A function may also be
+    given; it is called with the title, its depth and the data of the
+    page linking to it, and returns a number. When several pages link to
+    the same title, the highest score is kept.
+
+    Args:
+        seeds: A list of strings describing the Wikipedia pages to start
+            from. Ignored when the crawl is resumed from a checkpoint.
+        max_depth: Number of links to follow away from the seeds. Seeds
+            have depth zero.
+        max_pages: Optional maximum number of pages to fetch.
+        lang: Two letter language code describing the Wikipedia
+            language used to grab the data.
+        links: How to find the links of a page. Either 'all', for the
+            links given by wiki.links_as_list, one of the keys returned by
+            wikitext.get_internal_links ('ilinks', 'ilinks_p' or
+            'ilinks_li'), or a function taking the page data and returning
+            a list of titles.
+        max_workers: Maximum number of pages to fetch at the same time.
+        checkpoint: Optional path of a file used to save the state of the
+            crawl. If the file exists, the crawl is resumed from it.
+        checkpoint_every: Number of fetched pages between checkpoints.
+        priority: Optional name of a priority score, one of PRIORITIES, or
+            a function computing the score of a link.
+    """
+    def __init__(self, seeds, max_depth=2, max_pages=None, lang='en',
+                 links='all', max_workers=8, checkpoint=None,
+                 checkpoint_every=100, priority=None):
+        if priority is not None and not callable(priority) and \
+                priority not in PRIORITIES:
+            raise ValueError("priority must be 'inlinks', 'similarity' or a "
+                             "function")
+
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.lang = lang
+        self.links = links
+        self.max_workers = max_workers
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.priority = priority
+
+        self.pages = []
+        self.failures = {}
+        self._seen = set()
+        self._seed_links = set()
+        self._frontier = _Frontier()
+        self._in_flight = []
+        self._batch_done = set()
+
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self._load_checkpoint()
+        else:
+            for page_title in seeds:
+                self._add(page_title, 0, None, None)
+
+    def run(self):
+        """Fetch pages until the frontier is empty or the budget is used.
+
+        If the crawl is interrupted, by an error or from the keyboard, the
+        checkpoint is saved before the exception is raised again.
+
+        Returns:
+            A list of the titles of all of the pages fetched so far, in
+            the order that they were fetched.
+        """
+        try:
+            while self._frontier and not self._budget_used():
+                self._crawl_batch()
+                if self.checkpoint is not None:
+                    self.save_checkpoint()
+        except BaseException:
+            if self.checkpoint is not None:
+                self.save_checkpoint()
+            raise
+
+        return list(self.pages)
+
+    def save_checkpoint(self):
+        """Write the state of the crawl to the checkpoint file.
+        """
+        frontier = [list(x) for x in self._in_flight
+                    if x[0] not in self._batch_done]
+        frontier.extend(self._frontier.items())
+
+        seen = array.array('Q', sorted(self._seen))
+        state = dict(version=__version__, lang=self.lang, pages=self.pages,
+                     failures=self.failures, frontier=frontier,
+                     seed_links=sorted(self._seed_links),
+                     seen=base64.b64encode(seen.tobytes()).decode('ascii'))
+
+        blob = gzip.compress(json.dumps(state).encode('UTF-8'))
+        wikicache.atomic_write(self.checkpoint, blob)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __repr__(self):
+        msg = "<WikiCrawler: {0:d} pages fetched, {1:d} in frontier>"
+        return msg.format(len(self.pages), len(self._frontier))
+
+    def _crawl_batch(self):
+        """Fetch the next batch of pages from the frontier.
+
+        Pages of the batch that have not been fetched yet are kept in
+        the checkpoint, so that they are fetched again after a resume.
+        """
+        batch_size = self.max_workers * 4
+        if self.max_pages is not None:
+            batch_size = min(batch_size, self.max_pages - len(self.pages))
+        self._in_flight = self._frontier.pop(batch_size)
+        depths = {x[0]: x[1] for x in self._in_flight}
+
+        failures = {}
+        fetched = set()
+        pages = wiki.get_wiki_json_many(list(depths), self.lang,
+                                        self.max_workers, failures)
+        for page_title, page_data in pages:
+            # a redirect and its target in the same batch are one page
+            key = _title_hash(page_data['title'])
+            if key in fetched:
+                self._batch_done.add(page_title)
+                continue
+            fetched.add(key)
+            self._mark_seen(page_data['title'])
+            depth = depths[page_title]
+            if depth < self.max_depth:
+                links = self._page_links(page_data)
+                if depth == 0:
+                    self._seed_links.update(links)
+                for link in links:
+                    self._add(link, depth + 1, page_data, links)
+            self.pages.append(page_title)
+            self._batch_done.add(page_title)
+
+            if self.checkpoint is not None and \
+                    len(self.pages) % self.checkpoint_every == 0:
+                self.save_checkpoint()
+
+        for page_title, err in failures.items():
+            self.failures[page_title] = wiki.failure_record(page_title, err)
+
+        self._in_flight = []
+        self._batch_done.clear()
+
+    def _page_links(self, page_data):
+        if callable(self.links):
+            return self.links(page_data)
+        if self.links == 'all':
+            return [x.replace(' ', '_') for x in wiki.links_as_list(page_data)]
+
+        return wikitext.get_internal_links(page_data)[self.links]
+
+    def _budget_used(self):
+        return self.max_pages is not None and \
+            len(self.pages) >= self.max_pages
+
+    def _add(self, page_title, depth, anchor_data, anchor_links):
+        """Add a title to the frontier if it has not been seen before.
+
+        Titles that are already in the frontier have their depth and
+        score updated instead.
+        """
+        key = _title_hash(page_title)
+        if key in self._frontier:
+            score = self._score(page_title, depth, anchor_data, anchor_links,
+                                self._frontier.score(key))
+            self._frontier.update(key, depth, score)
+        elif key not in self._seen:
+            self._seen.add(key)
+            score = self._score(page_title, depth, anchor_data, anchor_links,
+                                None)
+            self._frontier.push(key, page_title, depth, score)
+
+    def _score(self, page_title, depth, anchor_data, anchor_links, current):
+        """Returns the priority score of a title reached from a page.
+
+        Args:
+            current: The score of the title in the frontier, or None if
+                it is not in the frontier yet.
+        """
+        if self.priority is None or anchor_data is None:
+            return 0 if current is None else current
+        if self.priority == 'inlinks':
+            return 1 if current is None else current + 1
+
+        if self.priority == 'similarity':
+            score = _jaccard(set(anchor_links), self._seed_links)
+        else:
+            score = self.priority(page_title, depth, anchor_data)
+
+        return score if current is None else max(score, current)
+
+    def _mark_seen(self, page_title):
+        """Record the title of a fetched page as seen.
+
+        The title is dropped from the frontier, where it may be waiting
+        when the page was reached through a redirect.
+        """
+        key = _title_hash(page_title)
+        self._seen.add(key)
+        self._frontier.remove(key)
+
+    def _load_checkpoint(self):
+        with gzip.open(self.checkpoint, 'rt', encoding='UTF-8') as infile:
+            state = json.load(infile)
+
+        seen = array.array('Q')
+        seen.frombytes(base64.b64decode(state['seen']))
+
+        self.lang = state['lang']
+        self.pages = state['pages']
+        self.failures = state['failures']
+        self._seen = set(seen)
+        self._seed_links = set(state.get('seed_links', []))
+        for entry in state['frontier']:
+            score = entry[2] if len(entry) > 2 else 0
+            self._frontier.push(_title_hash(entry[0]), entry[0], entry[1],
+                                score)
+
+        msg = "Resuming crawl with {0:d} pages fetched and {1:d} in frontier."
+        print(msg.format(len(self.pages), len(self._frontier)))
+
+
+###############################################################################
+# Private functions
+
+class _Frontier():
+    """Heap of titles waiting to be fetched, highest score first.
+
+    Titles with the same score come out in the order they were added, so
+    with a constant score the frontier is a first-in first-out queue. When
+    the score of a title changes a new heap item is pushed, and the old
+    one is skipped when it reaches the top.
+    """
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def push(self, key, page_title, depth, score):
+        order = next(self._counter)
+        self._entries[key] = [score, order, depth, page_title]
+        heapq.heappush(self._heap, (-score, order, key))
+
+    def update(self, key, depth, score):
+        entry = self._entries[key]
+        entry[2] = min(entry[2], depth)
+        if score != entry[0]:
+            entry[0] = score
+            heapq.heappush(self._heap, (-score, entry[1], key))
+
+    def score(self, key):
+        return self._entries[key][0]
+
+    def remove(self, key):
+        # the heap item is skipped when it reaches the top
+        self._entries.pop(key, None)
+
+    def pop(self, num):
+        """Removes up to num titles; returns a list of (title, depth, score).
+        """
+        output = []
+        while self._heap and len(output) < num:
+            neg_score, _, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != -neg_score:
+                continue
+            del self._entries[key]
+            output.append((entry[3], entry[2], entry[0]))
+
+        return output
+
+    def items(self):
+        """Returns a list of [title, depth, score], in the order popped.
+        """
+        entries = sorted(self._entries.values(), key=lambda x: (-x[0], x[1]))
+        return [[x[3], x[2], x[0]] for x in entries]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _title_hash(page_title):
+    """Returns a 64-bit integer hash of the alias key of a title.
+    """
+    digest = hashlib.blake2b(wikicache.alias_key(page_title).encode('UTF-8'),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def _jaccard(set_a, set_b):
+    """Returns the Jaccard similarity of two sets.
+    """
+    if not set_a and not set_b:
+        return 0.0
+    return len(set_a & set_b) / len(set_a | set_b)
@@ -0,0 +1,760 @@
+# -*- coding: utf-8 -*-
+"""Module for loading Wikipedia dump files into the page cache.
+
+Wikimedia publishes the content of every Wikipedia as dump files, which
+are a far cheaper way of getting hundreds of thousands of pages than the
+MediaWiki API. Two kinds of dumps are supported:
+
+- XML dumps of the wikitext of each page, such as
+  'enwiki-latest-pages-articles.xml.bz2'.
+- HTML dumps from Wikimedia Enterprise, holding one JSON record per page
+  with the rendered HTML, such as
+  'enwiki-NS0-20240601-ENTERPRISE-HTML.json.tar.gz'.
+
+Dumps are read as a stream, either plain or compressed with gzip, bzip2,
+xz or zstandard, so that only the pages being converted are held in
+memory. Each page is converted into a dictionary with the same shape as
+the data returned by wiki.get_wiki_json ('title', 'text', 'links',
+'langlinks', 'categories', 'sections', 'images', 'externallinks' and so
+on), and redirects are recorded in the alias index of the cache. Once a
+dump is imported, wiki.get_wiki_json, wikitext.get_internal_links and
+wikitext.WikiCorpus work on its pages without any network access:
+
+    num_pages = import_dump("enwiki-latest-pages-articles.xml.bz2")
+
+XML dumps only hold wikitext, which is turned into HTML by a small
+converter that keeps paragraphs, headings, lists and links but drops
+templates, tables and references. Links in XML dumps are all marked as
+existing, since the dump does not say which pages exist.
+"""
+
+import bz2
+import gzip
+import html
+from html.parser import HTMLParser
+import json
+import lzma
+import os
+import re
+import tarfile
+import urllib.parse
+import xml.etree.ElementTree as ET
+from xml.etree.ElementTree import Element, SubElement
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import wiki
+import wikicache
+
+__version__ = 1
+
+# Kinds of dump files understood by import_dump
+DUMP_FORMATS = ('xml', 'html')
+
+# Namespace numbers of the canonical namespace names, used for link
+# targets when a dump does not list its own namespaces
+_DEFAULT_NAMESPACES = {
+    'media': -2, 'special': -1, 'talk': 1, 'user': 2, 'user talk': 3,
+    'wikipedia': 4, 'project': 4, 'wikipedia talk': 5, 'project talk': 5,
+    'file': 6, 'image': 6, 'file talk': 7, 'image talk': 7,
+    'mediawiki': 8, 'mediawiki talk': 9, 'template': 10,
+    'template talk': 11, 'help': 12, 'help talk': 13, 'category': 14,
+    'category talk': 15, 'portal': 100, 'portal talk': 101, 'draft': 118,
+    'draft talk': 119, 'timedtext': 710, 'timedtext talk': 711,
+    'module': 828, 'module talk': 829
+}
+
+# Interwiki prefixes that look like language codes but are not
+_INTERWIKI_PREFIXES = {'b', 'c', 'd', 'f', 'm', 'n', 'q', 's', 'v', 'w',
+                       'mw', 'wikt', 'voy', 'species', 'commons', 'meta'}
+
+_COMMENT_RE = re.compile(r'<!--.*?-->', re.S)
+_REF_RE = re.compile(r'<ref\b[^>/]*/>|<ref\b[^>]*>.*?</ref\s*>', re.S | re.I)
+_DROP_TAG_RE = re.compile(r'<(gallery|math|chem|score|timeline|imagemap|'
+                          r'syntaxhighlight|source|templatedata|mapframe|'
+                          r'graph|hiero)\b[^>]*>(.*?)</\1\s*>', re.S | re.I)
+_TAG_RE = re.compile(r'</?[A-Za-z][^>]*>')
+_TEMPLATE_RE = re.compile(r'\{\{(?:(?!\{\{|\}\}).)*\}\}', re.S)
+_TABLE_RE = re.compile(r'\{\|(?:(?!\{\||\|\}).)*\|\}', re.S)
+_MAGIC_RE = re.compile(r'__[A-Z]+__')
+_QUOTES_RE = re.compile(r"'{2,}")
+_BRACKETS_RE = re.compile(r'\[\[|\]\]')
+_URL_RE = re.compile(r'https?://[^\s|\]\[}{<>"]+')
+_HEADING_RE = re.compile(r'^(={1,6})\s*(.+?)\s*\1\s*$')
+_LIST_RE = re.compile(r'^([*#:;]+)\s*(.*)$')
+_INLINE_RE = re.compile(r"\[\[([^\[\]|]*)(?:\|([^\[\]]*))?\]\]([a-z]*)|"
+                        r"\[(https?://[^\s\]]+)(?:\s+([^\]]*))?\]")
+_LANG_CODE_RE = re.compile(r'^[a-z]{2,3}(?:-[a-z]+)*$')
+_XML_NAME_RE = re.compile(r'^[A-Za-z_][\w.-]*$')
+
+_LIST_TAGS = {'*': ('ul', 'li'), '#': ('ol', 'li'), ';': ('dl', 'dt'),
+              ':': ('dl', 'dd')}
+_VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+              'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+
+###############################################################################
+# Public classes and functions
+
+def import_dump(path, lang='en', force=False, max_workers=4, batch_size=100,
+                namespaces=(0,), dump_format=None):
+    """Write the pages of a Wikipedia dump file into the cache.
+
+    The dump is read as a stream and its pages are handed, in batches, to
+    a pool of threads that convert them and write them to the cache
+    given to wiki.set_cache. Only a few batches are waiting at any time,
+    so memory use does not grow with the size of the dump. Redirects are
+    added to the alias index of the cache, and pages that cannot be
+    converted are reported and skipped.
+
+    Args:
+        path: Path of the dump file.
+        lang: Two letter language code of the Wikipedia the dump is from.
+        force: Boolean value. Should pages already in the cache be
+            overwritten.
+        max_workers: Number of threads converting and writing pages.
+        batch_size: Number of pages handed to a thread at a time.
+        namespaces: Numbers of the namespaces to import; by default only
+            articles.
+        dump_format: Either 'xml' or 'html'. If None, it is guessed from
+            the file name.
+
+    Returns:
+        Number of pages added to the cache.
+    """
+    cache = wiki.get_cache()
+    num_pages = 0
+    num_added = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = set()
+        batch = []
+        for record in _iter_records(path, namespaces, dump_format):
+            batch.append(record)
+            if len(batch) < batch_size:
+                continue
+
+            num_pages += len(batch)
+            futures.add(executor.submit(_write_batch, cache, batch, lang,
+                                        force))
+            batch = []
+            if len(futures) >= 2 * max_workers:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                num_added += sum(x.result() for x in done)
+            if num_pages % 10000 < batch_size:
+                print("Read {0:d} pages from the dump.".format(num_pages))
+
+        if batch:
+            num_pages += len(batch)
+            futures.add(executor.submit(_write_batch, cache, batch, lang,
+                                        force))
+        num_added += sum(x.result() for x in wait(futures).done)
+
+    msg = "Added {0:d} pages from a dump of {1:d} pages."
+    print(msg.format(num_added, num_pages))
+
+    return num_added
+
+
+def iter_dump(path, namespaces=(0,), dump_format=None):
+    """Yield the pages of a Wikipedia dump file without caching them.
+
+    Args:
+        path: Path of the dump file.
+        namespaces: Numbers of the namespaces to read; by default only
+            articles.
+        dump_format: Either 'xml' or 'html'. If None, it is guessed from
+            the file name.
+
+    Returns:
+        A generator of dictionaries shaped like the data returned by
+        wiki.get_wiki_json, one for each page that is not a redirect.
+    """
+    for record in _iter_records(path, namespaces, dump_format):
+        if record['redirect'] is None:
+            yield _record_to_page(record)
+
+
+def page_from_wikitext(page_title, text, pageid=0, revid=0,
+                       namespaces=None):
+    """Convert the wikitext of a page into the shape of get_wiki_json.
+
+    Args:
+        page_title: A string containing the page title.
+        text: The wikitext of the page.
+        pageid: Optional integer id of the page.
+        revid: Optional integer id of the revision.
+        namespaces: Optional dictionary mapping lower case namespace names
+            to their numbers; defaults to the English canonical names.
+
+    Returns:
+        A dictionary with the same keys as the data returned by
+        wiki.get_wiki_json.
+    """
+    if namespaces is None:
+        namespaces = _DEFAULT_NAMESPACES
+
+    externallinks = _unique(_URL_RE.findall(text))
+    text = _COMMENT_RE.sub('', text)
+    text = _REF_RE.sub('', text)
+    text = _drop_nested(text, _TEMPLATE_RE)
+    text = _drop_nested(text, _TABLE_RE)
+
+    found = dict(links=[], images=[], categories=[], langlinks=[])
+    text = _DROP_TAG_RE.sub(lambda x: _gallery_images(x, found, namespaces),
+                            text)
+    text = _take_special_links(text, found, namespaces)
+    text = html.unescape(_TAG_RE.sub('', _MAGIC_RE.sub('', text)))
+
+    tree = _wikitext_tree(text, found['links'], namespaces)
+
+    return _page_dict(page_title, pageid, revid, tree, found,
+                      externallinks)
+
+
+def page_from_html(page_title, page_html, pageid=0, revid=0):
+    """Convert the Parsoid HTML of a page into the shape of get_wiki_json.
+
+    Args:
+        page_title: A string containing the page title.
+        page_html: The HTML of the page, as found in the HTML dumps.
+        pageid: Optional integer id of the page.
+        revid: Optional integer id of the revision.
+
+    Returns:
+        A dictionary with the same keys as the data returned by
+        wiki.get_wiki_json.
+    """
+    builder = _XHTMLBuilder()
+    builder.feed(page_html)
+    builder.close()
+
+    return _page_dict(page_title, pageid, revid, builder.root, builder.found,
+                      builder.externallinks)
+
+
+###############################################################################
+# Private functions
+
+def _iter_records(path, namespaces, dump_format):
+    """Yield a dictionary describing each page of a dump file.
+
+    Records have the keys 'title', 'ns', 'pageid', 'revid', 'redirect'
+    (the target of a redirect, or None), 'redirects' (titles redirecting
+    to the page), 'text' (wikitext), 'html' and 'namespaces'.
+    """
+    if dump_format is None:
+        dump_format = _guess_format(path)
+    if dump_format not in DUMP_FORMATS:
+        raise ValueError("dump_format must be 'xml' or 'html'")
+
+    if dump_format == 'html' and '.tar' in os.path.basename(path):
+        records = _iter_tar_records(path)
+    else:
+        stream = _open_stream(path)
+        if dump_format == 'xml':
+            records = _iter_xml_records(stream)
+        else:
+            records = _iter_html_records(stream)
+
+    for record in records:
+        if record['ns'] in namespaces:
+            yield record
+
+
+def _guess_format(path):
+    name = os.path.basename(path).lower()
+    if '.xml' in name:
+        return 'xml'
+    if '.json' in name or '.tar' in name:
+        return 'html'
+
+    raise ValueError("Cannot tell the format of '" + path + "'; give "
+                     "dump_format")
+
+
+def _open_stream(path):
+    """Open a dump file for reading, decompressing it if needed.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'),
+                                                          closefd=True)
+
+    return open(path, 'rb')
+
+
+def _iter_xml_records(stream):
+    """Yield the pages of a MediaWiki XML export, clearing each once used.
+    """
+    site_namespaces = dict(_DEFAULT_NAMESPACES)
+    with stream:
+        context = ET.iterparse(stream, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end':
+                continue
+            tag = elem.tag.rsplit('}', 1)[-1]
+            if tag == 'namespace' and elem.text:
+                site_namespaces[elem.text.lower()] = int(elem.get('key'))
+            elif tag == 'page':
+                redirect = elem.find('{*}redirect')
+                yield dict(title=elem.findtext('{*}title'),
+                           ns=int(elem.findtext('{*}ns', '0')),
+                           pageid=int(elem.findtext('{*}id', '0')),
+                           revid=int(elem.findtext('{*}revision/{*}id', '0')),
+                           redirect=None if redirect is None else
+                           redirect.get('title'),
+                           redirects=[],
+                           text=elem.findtext('{*}revision/{*}text', ''),
+                           html=None, namespaces=site_namespaces)
+                root.clear()
+
+
+def _iter_tar_records(path):
+    """Yield the pages of each JSON lines file inside a tar archive.
+    """
+    with tarfile.open(path, 'r|*') as tfile:
+        for member in tfile:
+            if member.isfile():
+                yield from _iter_html_records(tfile.extractfile(member))
+
+
+def _iter_html_records(stream):
+    """Yield the pages of a file of Wikimedia Enterprise JSON records.
+    """
+    with stream:
+        for line in stream:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            body = data.get('article_body', {})
+            yield dict(title=data['name'],
+                       ns=data.get('namespace', {}).get('identifier', 0),
+                       pageid=data.get('identifier', 0),
+                       revid=data.get('version', {}).get('identifier', 0),
+                       redirect=None,
+                       redirects=[x['name'] for x in
+                                  data.get('redirects', [])],
+                       text=body.get('wikitext', ''),
+                       html=body.get('html'), namespaces=None)
+
+
+def _write_batch(cache, batch, lang, force):
+    """Convert a batch of records and write them to the cache.
+
+    Returns:
+        Number of pages written.
+    """
+    num_added = 0
+    redirects = {}
+    for record in batch:
+        if record['redirect'] is not None:
+            target = record['redirect'].split('#')[0]
+            redirects.setdefault(target, []).append(record['title'])
+            continue
+
+        key = wikicache.normalize_title(record['title'])
+        if not force and cache.contains(key, lang):
+            continue
+        try:
+            page_data = _record_to_page(record)
+        except Exception as err:
+            print("Skipping page '" + record['title'] + "': " + str(err))
+            continue
+
+        cache.put(key, lang, page_data)
+        cache.put_aliases([record['title']] + record['redirects'], key, lang)
+        num_added += 1
+
+    for target, page_titles in redirects.items():
+        cache.put_aliases(page_titles, target, lang)
+
+    return num_added
+
+
+def _record_to_page(record):
+    if record['html'] is not None:
+        return page_from_html(record['title'], record['html'],
+                              record['pageid'], record['revid'])
+
+    return page_from_wikitext(record['title'], record['text'],
+                              record['pageid'], record['revid'],
+                              record['namespaces'])
+
+
+def _page_dict(page_title, pageid, revid, tree, found, externallinks):
+    """Assemble the page data from an XHTML tree and the links found.
+    """
+    links = []
+    for ns, target, exists in _unique(found['links']):
+        link = {'ns': ns, '*': target}
+        if exists:
+            link['exists'] = ''
+        links.append(link)
+
+    return {
+        'title': page_title,
+        'pageid': pageid,
+        'revid': revid,
+        'displaytitle': html.escape(page_title, quote=False),
+        'text': {'*': ET.tostring(tree, encoding='unicode')},
+        'langlinks': [{'lang': lang, 'url': 'https://' + lang +
+                       '.wikipedia.org/wiki/' + _quote_title(target),
+                       '*': target} for lang, target in
+                      _unique(found['langlinks'])],
+        'categories': [{'sortkey': '', '*': x} for x in
+                       _unique(found['categories'])],
+        'links': links,
+        'templates': [],
+        'images': _unique(found['images']),
+        'externallinks': _unique(externallinks),
+        'sections': _sections(page_title, tree),
+        'iwlinks': [],
+        'properties': []
+    }
+
+
+def _sections(page_title, tree):
+    """Describe the headings of a page as the parse API does.
+    """
+    sections = []
+    levels = []
+    numbers = []
+    for elem in tree.iter():
+        if elem.tag not in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+            continue
+        level = int(elem.tag[1])
+        while levels and levels[-1] >= level:
+            levels.pop()
+        levels.append(level)
+        numbers = numbers[:len(levels)]
+        if len(numbers) < len(levels):
+            numbers.append(0)
+        numbers[-1] += 1
+
+        line = "".join(elem.itertext()).strip()
+        anchor = elem.get('id')
+        if anchor is None:
+            span = elem.find('span')
+            anchor = line.replace(' ', '_') if span is None else \
+                span.get('id', line.replace(' ', '_'))
+        sections.append(dict(toclevel=len(levels), level=str(level),
+                             line=line,
+                             number='.'.join(str(x) for x in numbers),
+                             index=str(len(sections) + 1),
+                             fromtitle=wikicache.normalize_title(page_title),
+                             byteoffset=None, anchor=anchor))
+
+    return sections
+
+
+def _wikitext_tree(text, links, namespaces):
+    """Build the XHTML tree of the paragraphs, headings and lists of text.
+    """
+    root = Element('div', {'class': 'mw-parser-output'})
+    para = []
+    lists = []
+
+    def flush():
+        if para:
+            _add_inline(SubElement(root, 'p'), " ".join(para), links,
+                        namespaces)
+            del para[:]
+
+    for line in text.split('\n'):
+        line = line.strip()
+        heading = _HEADING_RE.match(line)
+        item = _LIST_RE.match(line)
+        if heading is not None:
+            flush()
+            del lists[:]
+            level = min(len(heading.group(1)), 6)
+            span = SubElement(SubElement(root, 'h' + str(level)), 'span',
+                              {'class': 'mw-headline'})
+            _add_inline(span, heading.group(2), links, namespaces)
+            span.set('id', "".join(span.itertext()).strip().replace(' ', '_'))
+        elif item is not None:
+            flush()
+            _add_list_item(root, lists, item.group(1), item.group(2), links,
+                           namespaces)
+        elif not line or line.startswith('----'):
+            flush()
+            del lists[:]
+        else:
+            del lists[:]
+            para.append(line)
+    flush()
+
+    return root
+
+
+def _add_list_item(root, lists, markers, text, links, namespaces):
+    """Add an item to the nested lists open at the end of the tree.
+
+    Args:
+        lists: Stack of [marker, list element, last item] for each open
+            list, updated in place.
+        markers: The list markers at the start of the line, such as '*#'.
+    """
+    depth = 0
+    while depth < min(len(lists), len(markers)) and \
+            _LIST_TAGS[lists[depth][0]][0] == _LIST_TAGS[markers[depth]][0]:
+        depth += 1
+    del lists[depth:]
+
+    for marker in markers[depth:]:
+        if lists and lists[-1][2] is None:
+            lists[-1][2] = SubElement(lists[-1][1],
+                                      _LIST_TAGS[lists[-1][0]][1])
+        parent = lists[-1][2] if lists else root
+        lists.append([marker, SubElement(parent, _LIST_TAGS[marker][0]),
+                      None])
+
+    lists[-1][2] = SubElement(lists[-1][1], _LIST_TAGS[markers[-1]][1])
+    _add_inline(lists[-1][2], text, links, namespaces)
+
+
+def _add_inline(elem, text, links, namespaces):
+    """Append text with internal and external links to an element.
+    """
+    start = 0
+    for match in _INLINE_RE.finditer(text):
+        _append_text(elem, _strip_quotes(text[start:match.start()]))
+        start = match.end()
+
+        if match.group(4) is not None:
+            link = SubElement(elem, 'a', {'rel': 'nofollow',
+                                          'class': 'external text',
+                                          'href': match.group(4)})
+            link.text = _strip_quotes(match.group(5) or match.group(4))
+            continue
+
+        target, _, fragment = match.group(1).strip().partition('#')
+        label = match.group(2) if match.group(2) is not None else \
+            match.group(1).lstrip(':')
+        label = _strip_quotes(label) + match.group(3)
+        if not target:
+            _append_text(elem, label)
+            continue
+
+        ns, target = _split_namespace(target, namespaces)
+        links.append((ns, target, True))
+        href = '/wiki/' + _quote_title(target)
+        if fragment:
+            href += '#' + _quote_title(fragment)
+        link = SubElement(elem, 'a', {'href': href, 'title': target})
+        link.text = label
+    _append_text(elem, _strip_quotes(text[start:]))
+
+
+def _append_text(elem, text):
+    if not text:
+        return
+    if len(elem):
+        elem[-1].tail = (elem[-1].tail or '') + text
+    else:
+        elem.text = (elem.text or '') + text
+
+
+def _strip_quotes(text):
+    """Remove the quotes marking bold and italic text.
+    """
+    return _QUOTES_RE.sub('', text)
+
+
+def _drop_nested(text, pattern):
+    """Remove nested constructs, such as templates, innermost first.
+    """
+    num = 1
+    while num:
+        text, num = pattern.subn('', text)
+
+    return text
+
+
+def _take_special_links(text, found, namespaces):
+    """Remove links to files, categories and other languages from wikitext.
+
+    The targets are added to the 'images', 'categories' and 'langlinks'
+    lists of found. Links are matched with their nested brackets, since
+    the captions of files often contain links.
+    """
+    output = []
+    start = 0
+    pos = text.find('[[')
+    while pos >= 0:
+        end = _closing_brackets(text, pos)
+        if end < 0:
+            break
+        target = text[pos + 2:end - 2].split('|', 1)[0].strip()
+        if _add_special_link(target, found, namespaces):
+            output.append(text[start:pos])
+            start = end
+            pos = text.find('[[', end)
+        else:
+            pos = text.find('[[', pos + 2)
+    output.append(text[start:])
+
+    return "".join(output)
+
+
+def _closing_brackets(text, pos):
+    """Returns the index after the ']]' closing the '[[' at pos, or -1.
+    """
+    depth = 0
+    for match in _BRACKETS_RE.finditer(text, pos):
+        depth += 1 if match.group(0) == '[[' else -1
+        if depth == 0:
+            return match.end()
+
+    return -1
+
+
+def _add_special_link(target, found, namespaces):
+    """Record a file, category or language link; returns False otherwise.
+    """
+    if ':' not in target or target.startswith(':'):
+        return False
+
+    prefix, name = target.split(':', 1)
+    key = prefix.strip().replace('_', ' ').lower()
+    name = _normalize_title(name)
+    ns = namespaces.get(key)
+    if ns in (6, -2):
+        found['images'].append(name.replace(' ', '_'))
+    elif ns == 14:
+        found['categories'].append(name.replace(' ', '_'))
+    elif ns is None and _LANG_CODE_RE.match(key) and \
+            key not in _INTERWIKI_PREFIXES:
+        found['langlinks'].append((key, name))
+    else:
+        return False
+
+    return True
+
+
+def _gallery_images(match, found, namespaces):
+    """Record the files of a gallery tag; other dropped tags give nothing.
+    """
+    if match.group(1).lower() == 'gallery':
+        for line in match.group(2).split('\n'):
+            _add_special_link(line.split('|', 1)[0].strip(), found,
+                              namespaces)
+
+    return ''
+
+
+def _split_namespace(target, namespaces):
+    """Returns the namespace number and the normalized form of a title.
+    """
+    target = _normalize_title(target.lstrip(':'))
+    if ':' in target:
+        prefix, name = target.split(':', 1)
+        ns = namespaces.get(prefix.strip().lower())
+        if ns is not None:
+            return ns, prefix.strip() + ':' + _normalize_title(name)
+
+    return 0, target
+
+
+def _normalize_title(page_title):
+    """Returns a title with single spaces and a capitalized first letter.
+    """
+    page_title = re.sub('[ _]+', ' ', page_title).strip()
+    return page_title[:1].upper() + page_title[1:]
+
+
+def _quote_title(page_title):
+    return urllib.parse.quote(page_title.replace(' ', '_'),
+                              safe=";@$!*(),/~:")
+
+
+def _unique(values):
+    """Returns the values without repeats, in the order first seen.
+    """
+    return list(dict.fromkeys(values))
+
+
+class _XHTMLBuilder(HTMLParser):
+    """Parser turning Parsoid HTML into a well-formed XHTML tree.
+
+    The body of the page is placed inside a div element, as in the output
+    of the parse API, with its section elements removed so that
+    paragraphs are children of the div. Relative links are rewritten to
+    start with '/wiki/', and internal, external, language, category and
+    file links are collected along the way.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = Element('div', {'class': 'mw-parser-output'})
+        self.found = dict(links=[], images=[], categories=[], langlinks=[])
+        self.externallinks = []
+        self._stack = [self.root]
+        self._skip_tag = None
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip:
+            self._skip += tag == self._skip_tag
+            return
+        if tag in ('head', 'script', 'style', 'template'):
+            self._skip_tag = tag
+            self._skip = 1
+            return
+        if tag in ('html', 'body', 'section'):
+            return
+
+        attrs = {x: y or '' for x, y in attrs if _XML_NAME_RE.match(x)}
+        rel = attrs.get('rel', '').split()
+        href = attrs.get('href', '')
+        if tag in ('link', 'meta'):
+            self._add_page_property(rel, href)
+            return
+
+        if href.startswith('./'):
+            attrs['href'] = '/wiki/' + href[2:]
+            if 'mw:WikiLink' in rel:
+                target = urllib.parse.unquote(href[2:].split('?')[0])
+                ns, target = _split_namespace(target.split('#')[0],
+                                              _DEFAULT_NAMESPACES)
+                exists = 'new' not in attrs.get('class', '').split()
+                self.found['links'].append((ns, target, exists))
+        elif 'mw:ExtLink' in rel:
+            self.externallinks.append(href)
+        if tag == 'img' and attrs.get('resource', '').startswith('./'):
+            name = urllib.parse.unquote(attrs['resource'][2:])
+            self.found['images'].append(name.split(':', 1)[-1])
+
+        elem = SubElement(self._stack[-1], tag, attrs)
+        if tag not in _VOID_TAGS:
+            self._stack.append(elem)
+
+    def handle_endtag(self, tag):
+        if self._skip:
+            self._skip -= tag == self._skip_tag
+            return
+
+        for pos in range(len(self._stack) - 1, 0, -1):
+            if self._stack[pos].tag == tag:
+                del self._stack[pos:]
+                return
+
+    def handle_data(self, data):
+        if not self._skip:
+            _append_text(self._stack[-1], data)
+
+    def _add_page_property(self, rel, href):
+        if 'mw:PageProp/Category' in rel and href.startswith('./'):
+            name = urllib.parse.unquote(href[2:].split('#')[0])
+            self.found['categories'].append(name.split(':', 1)[-1])
+        elif 'mw:PageProp/Language' in rel:
+            parts = urllib.parse.urlsplit(href)
+            if parts.path.startswith('/wiki/'):
+                name = urllib.parse.unquote(parts.path[6:])
+                self.found['langlinks'].append(
+                    (parts.netloc.split('.')[0], name.replace('_', ' ')))
@@ -5,10 +5,11 @@
 import re
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import SubElement
+import requests
 import wiki
 import wikitext
 
-__version__ = 1
+__version__ = 2
 
 
 ###############################################################################
@@ -27,7 +28,11 @@ def get_wikihistory_json(page_title, force=False):
 
     This function either loads a cached version of the page or,
     if a local version of the page is not available, calls the
-    MediaWiki API directly.
+    MediaWiki API directly. Histories are kept under the language
+    'history' of the file cache, using the same layout and codec as
+    the page cache when that is a file cache. The file is written
+    atomically, and other threads and processes asking for the same
+    page wait for the download rather than repeating it.
 
     Args:
         page_title: A string containing the page title.
@@ -35,26 +40,58 @@ def get_wikihistory_json(page_title, force=False):
     Returns:
         A dictionary object with the complete parsed JSON data.
     """
-    import os
-    import json
-    import gzip
-    import time
+    cache = _history_cache()
+    if force or not cache.contains(page_title, 'history'):
+        with cache.lock(page_title, 'history'):
+            if force or not cache.contains(page_title, 'history'):
+                query = _wiki_page_revisions(page_title)
+                parse = _get_page_history(query)
+                page_history = dict(query=query, parse=parse)
+                cache.put(page_title, 'history', page_history)
 
-    file_path = _wikihistory_json_path(page_title)
-    if force or not os.path.exists(file_path):
+    return cache.get(page_title, 'history')
 
-        query = _wiki_page_revisions(page_title)
-        parse = _get_page_history(query)
-        page_history = dict(query=query, parse=parse)
 
-        with gzip.open(file_path, 'wt', encoding='UTF-8') as fout:
-            json.dump(page_history, fout)
-        time.sleep(1)  # sleep for one second to avoid API limits
+async def aget_wikihistory_json(page_title, force=False, session=None):
+    """Returns JSON data for the history of a page without blocking.
 
-    with gzip.open(file_path, 'rt', encoding='UTF-8') as infile:
-        page_history = json.load(infile)
+    This is the asyncio counterpart of get_wikihistory_json and uses the
+    same cache and lock. The revisions of each year are downloaded
+    concurrently, through the rate limiter shared with the other calls
+    to Wikipedia.
 
-    return page_history
+    Args:
+        page_title: A string containing the page title.
+        force: Boolean value. Should the history be downloaded again.
+        session: Optional aiohttp session from wiki.async_session.
+
+    Returns:
+        A dictionary object with the complete parsed JSON data.
+    """
+    import asyncio
+
+    cache = _history_cache()
+    cached = await asyncio.to_thread(cache.contains, page_title, 'history')
+    if force or not cached:
+        if session is None:
+            async with wiki.async_session() as session:
+                return await aget_wikihistory_json(page_title, force,
+                                                   session)
+
+        page_json = await wiki.aget_wiki_json(page_title, session=session)
+        async with wiki.alock_cache(page_title, 'history', cache):
+            cached = await asyncio.to_thread(cache.contains, page_title,
+                                             'history')
+            if force or not cached:
+                query = await _awiki_page_revisions(page_json, session)
+                parse = await asyncio.gather(*[
+                    _aget_revision(rev, session)
+                    for rev in _yearly_revisions(query)])
+                page_history = dict(query=query, parse=list(parse))
+                await asyncio.to_thread(cache.put, page_title, 'history',
+                                        page_history)
+
+    return await asyncio.to_thread(cache.get, page_title, 'history')
 
 
 def get_history_meta(page_link):
@@ -109,45 +146,24 @@ def get_history_meta(page_link):
 # Private functions
 #pylint: disable-msg=too-many-locals
 
-def _wikihistory_json_path(page_title):
-    """Returns local path to JSON file for Wikipedia page data.
-
-    Args:
-        page_title: A string containing the page title.
-
-    Returns:
-        A string describing a relative path to file.
+def _history_cache():
+    """Returns the file cache used to store page histories.
     """
-    import os
-    page_title = re.sub("[ /]", "_", page_title)
-    stat289_base_dir = os.path.dirname(os.getcwd())
-
-    dir_name = os.path.join(stat289_base_dir, "data", "history")
-    if not os.path.exists(dir_name):
-        os.makedirs(dir_name)
+    import wikicache
 
-    file_name = page_title + ".json.gz"
-    file_path = os.path.join(dir_name, file_name)
+    cache = wiki.get_cache()
+    if isinstance(cache, wikicache.FileCache):
+        return cache
 
-    return file_path
+    return wikicache.FileCache()
 
 
 def _wiki_page_revisions(page_title):
-    import requests
-    base_api_url = 'https://' + 'en' + '.wikipedia.org/w/api.php?'
-
     page_json = wiki.get_wiki_json(page_title)
     pageid = page_json['pageid']
-    revid = page_json['revid']
 
-    api_query = base_api_url + \
-        "action=query&" + "format=json&" + \
-        "prop=revisions&" + "rvprop=ids|size|timestamp|comment|user&" \
-        "rvlimit=max&" + \
-        "pageids={0:d}&".format(pageid) + \
-        "rvstartid={0:d}&".format(revid)
-    req = requests.get(api_query)
-    page_data = req.json()
+    api_query = _revisions_query(page_json)
+    page_data = _checked_json(wiki.http_get(api_query), 'query')
 
     rev_data = page_data['query']['pages'][str(pageid)]['revisions']
 
@@ -155,8 +171,7 @@ def _wiki_page_revisions(page_title):
         rvcontinue = page_data['continue']['rvcontinue']
         api_query_continue = api_query + \
             "rvcontinue={0:s}&".format(rvcontinue)
-        req = requests.get(api_query_continue)
-        page_data = req.json()
+        page_data = _checked_json(wiki.http_get(api_query_continue), 'query')
         rev_data += page_data['query']['pages'][str(pageid)]['revisions']
         msg = "Loaded {0:d} revisions, through {1:s}"
         print(msg.format(len(rev_data), rev_data[-1]['timestamp']))
@@ -165,30 +180,114 @@ def _wiki_page_revisions(page_title):
 
 
 def _get_page_history(rev_data):
-    import requests
-
-    base_api_url = 'https://' + 'en' + '.wikipedia.org/w/api.php?'
     page_history = []
+
+    for rev in _yearly_revisions(rev_data):
+        # grab the page
+        revid = rev['revid']
+        req = wiki.http_get(_revision_query(revid))
+        page_data = _checked_json(req, 'parse')['parse']
+
+        page_history.append((rev, page_data))
+
+        # output progress
+        print("Grabbed page at {0:d}".format(revid))
+
+    return page_history
+
+
+async def _awiki_page_revisions(page_json, session):
+    pageid = page_json['pageid']
+
+    api_query = _revisions_query(page_json)
+    req = await wiki.ahttp_get(api_query, session)
+    page_data = await _achecked_json(req, 'query')
+
+    rev_data = page_data['query']['pages'][str(pageid)]['revisions']
+
+    while 'continue' in page_data:
+        rvcontinue = page_data['continue']['rvcontinue']
+        api_query_continue = api_query + \
+            "rvcontinue={0:s}&".format(rvcontinue)
+        req = await wiki.ahttp_get(api_query_continue, session)
+        page_data = await _achecked_json(req, 'query')
+        rev_data += page_data['query']['pages'][str(pageid)]['revisions']
+        msg = "Loaded {0:d} revisions, through {1:s}"
+        print(msg.format(len(rev_data), rev_data[-1]['timestamp']))
+
+    return rev_data
+
+
+async def _aget_revision(rev, session):
+    revid = rev['revid']
+    req = await wiki.ahttp_get(_revision_query(revid), session)
+    page_data = (await _achecked_json(req, 'parse'))['parse']
+
+    print("Grabbed page at {0:d}".format(revid))
+
+    return (rev, page_data)
+
+
+def _checked_json(req, key):
+    """Returns the JSON body of a response, after checking it for errors.
+
+    Raises the errors of wiki.check_api_response if the request failed or
+    the body has no element named key.
+    """
+    if req.status_code != requests.codes['ok']:
+        wiki.check_api_response(req.status_code, None)
+    page_data = req.json()
+    wiki.check_api_response(req.status_code, page_data, key)
+
+    return page_data
+
+
+async def _achecked_json(req, key):
+    """Returns the JSON body of an aiohttp response, checked for errors.
+    """
+    if req.status != requests.codes['ok']:
+        wiki.check_api_response(req.status, None)
+    page_data = await req.json(content_type=None)
+    wiki.check_api_response(req.status, page_data, key)
+
+    return page_data
+
+
+def _revisions_query(page_json):
+    """Returns the URL listing the revisions of a page, newest first.
+    """
+    base_api_url = wiki.get_api_url('en') + '?'
+
+    return base_api_url + \
+        "action=query&" + "format=json&" + \
+        "prop=revisions&" + "rvprop=ids|size|timestamp|comment|user&" \
+        "rvlimit=max&" + \
+        "pageids={0:d}&".format(page_json['pageid']) + \
+        "rvstartid={0:d}&".format(page_json['revid'])
+
+
+def _revision_query(revid):
+    """Returns the URL of the parsed page at a revision.
+    """
+    base_api_url = wiki.get_api_url('en') + '?'
+
+    return base_api_url + "action=parse&" + "format=json&" + \
+        "oldid={0:d}&".format(revid)
+
+
+def _yearly_revisions(rev_data):
+    """Returns the newest revision of each year, from a list newest first.
+    """
+    output = []
     last_year = int(rev_data[0]['timestamp'][:4]) + 1
 
     for rev in rev_data:
         this_year = int(rev['timestamp'][:4])
         if this_year < last_year:
             last_year = this_year
+            output.append(rev)
 
-            # grab the page
-            revid = rev['revid']
-            api_query = base_api_url + "action=parse&" + "format=json&" + \
-                "oldid={0:d}&".format(revid)
-            req = requests.get(api_query)
-            page_data = req.json()['parse']
-
-            page_history.append((rev, page_data))
-
-            # output progress
-            print("Grabbed page at {0:d}".format(revid))
-
-    return page_history
+    return output
 
 
 def _top_words_doc(doc, wcorp):
@@ -157,7 +157,7 @@ def _download_img_links(img_links, img_names):
     from os.path import join, dirname, exists
     import os
     import shutil
-    import requests
+    import wiki
 
     stat289_base_dir = dirname(os.getcwd())
     dir_name = join(stat289_base_dir, "data", "img")
@@ -168,11 +168,11 @@ def _download_img_links(img_links, img_names):
         output_path = join(dir_name, page_title)
         if not os.path.exists(output_path):
             print("Pulling image from MediaWiki: '" + page_title + "'")
-            req = requests.get(link, stream=True)
-            if req.status_code == 200:
-                with open(output_path, 'wb') as fin:
-                    req.raw.decode_content = True
-                    shutil.copyfileobj(req.raw, fin)
+            with wiki.http_get(link, stream=True) as req:
+                if req.status_code == 200:
+                    with open(output_path, 'wb') as fin:
+                        req.raw.decode_content = True
+                        shutil.copyfileobj(req.raw, fin)
 
 
 def _page_img_links(page_title, min_size, max_size):
@@ -204,7 +204,7 @@ def _page_img_links(page_title, min_size, max_size):
             size = max(height, width)
             if min_size <= size <= max_size:
                 if img.attrib['src'][-3:] in ['jpg', 'png']:
-                    img_links.append("https://" + img.attrib['src'][2:])
+                    img_links.append(wiki.absolute_url(img.attrib['src']))
                     sizes.append(max(height, width))
 
     return img_links, sizes
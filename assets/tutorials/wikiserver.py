@@ -0,0 +1,661 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for the MediaWiki API, for testing and load testing.
+
+WikiServer answers the requests made by the wiki, wikihistory and
+wikiimage modules from a fixture corpus rather than from Wikipedia:
+the parse action (by title, with redirects, or by revision), the query
+action for the revisions of a page, with continuation, and for basic
+information about a list of titles, and image downloads. Latency,
+server errors and throttling (429 responses with a Retry-After header)
+can be injected at given rates, so that the throughput of the fetch
+layer and its handling of retries and rate limits can be measured on one
+machine with no network access:
+
+    with WikiServer(latency=0.05, error_rate=0.01,
+                    throttle_rate=0.02) as server:
+        wiki.set_api_url(server.api_url)
+        pages = dict(wiki.get_wiki_json_many(titles))
+        print(server.stats())
+
+The corpus is either a SyntheticCorpus of generated pages linking to one
+another, or a CacheCorpus serving the pages of an existing cache, such as
+one filled by wikidump.import_dump. Revision histories are generated for
+both. The server can also be run from the command line, after which
+other processes reach it through the WIKI_API_URL environment variable:
+
+    python wikiserver.py --port 8080 --latency 0.05 --throttle-rate 0.02
+    WIKI_API_URL=http://127.0.0.1:8080/w/api.php python benchmark.py
+"""
+
+import datetime
+import json
+import random
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import wikicache
+
+__version__ = 1
+
+# Date of the newest revision of every page, and the days between
+# revisions, for the generated revision histories
+_HISTORY_START = datetime.datetime(2018, 10, 1)
+_HISTORY_STEP = datetime.timedelta(days=30)
+
+
+###############################################################################
+# Public classes and functions
+
+class WikiServer():
+    """HTTP server imitating the MediaWiki API and the image servers.
+
+    Each request first waits for latency seconds, plus a random extra of up
+    to jitter seconds. It is then answered with a 429 response with
+    probability throttle_rate, or with a server error with probability
+    error_rate, before the corpus is consulted. Image URLs in the HTML of
+    pages are rewritten to point at the server, which returns a small
+    PNG image for any path under '/upload/'.
+
+    Args:
+        corpus: A SyntheticCorpus or CacheCorpus, or the location of a
+            cache given to wikicache.open_cache. If None, a SyntheticCorpus
+            with its default settings.
+        host: Address to listen on.
+        port: Port to listen on; zero picks a free port.
+        latency: Seconds to wait before answering each request.
+        jitter: Maximum number of extra seconds to wait, chosen at random.
+        error_rate: Probability of answering with error_status.
+        throttle_rate: Probability of answering with a 429 response.
+        retry_after: Seconds given in the Retry-After header of 429
+            responses.
+        error_status: HTTP status code of injected server errors.
+        revisions_per_page: Number of revisions returned by each query
+            for revisions before a continuation is needed.
+        seed: Optional seed for the random choices of the server.
+    """
+    def __init__(self, corpus=None, host='127.0.0.1', port=0, latency=0.0,
+                 jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=1, error_status=500, revisions_per_page=50,
+                 seed=None):
+        if corpus is None:
+            corpus = SyntheticCorpus()
+        elif isinstance(corpus, str):
+            corpus = CacheCorpus(wikicache.open_cache(corpus))
+
+        self.corpus = corpus
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.error_status = error_status
+        self.revisions_per_page = revisions_per_page
+        self.base_url = None
+        self.api_url = None
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._httpd = None
+        self._thread = None
+        self.reset_stats()
+
+    def start(self):
+        """Start serving requests from a background thread.
+
+        Returns:
+            The server itself, with base_url and api_url set.
+        """
+        self._bind()
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+        return self
+
+    def serve_forever(self):
+        """Serve requests from the current thread until interrupted.
+        """
+        if self._httpd is None:
+            self._bind()
+        try:
+            self._httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._httpd.server_close()
+            self._httpd = None
+
+    def stop(self):
+        """Stop the server started by start and close its socket.
+        """
+        if self._httpd is None:
+            return
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._httpd = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """Returns a dictionary counting the requests answered so far.
+
+        The counts are of all 'requests', of those answered with a 429
+        ('throttled') or an injected error ('errors'), and of the 'parse',
+        'query', 'image' and 'missing' responses, together with the
+        'bytes' sent in response bodies.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        """Set all of the counts returned by stats back to zero.
+        """
+        with self._lock:
+            self._stats = dict(requests=0, throttled=0, errors=0, parse=0,
+                               query=0, image=0, missing=0, bytes=0)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __repr__(self):
+        return "<WikiServer: {0:s}>".format(str(self.api_url))
+
+    def _bind(self):
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.wiki_server = self
+        self.port = self._httpd.server_address[1]
+        self.base_url = "http://{0:s}:{1:d}".format(self.host, self.port)
+        self.api_url = self.base_url + "/w/api.php"
+
+    def _respond(self, path, params):
+        """Returns the status, extra headers and body for a request.
+        """
+        with self._lock:
+            self._stats['requests'] += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            roll = self._random.random()
+        if delay > 0:
+            time.sleep(delay)
+
+        if roll < self.throttle_rate:
+            self._count('throttled')
+            headers = {'Retry-After': str(self.retry_after)}
+            return 429, headers, _json_body(dict(error=dict(
+                code='ratelimited', info="Too many requests")))
+        if roll < self.throttle_rate + self.error_rate:
+            self._count('errors')
+            return self.error_status, {}, b"Injected server error"
+
+        if path.startswith('/upload/'):
+            self._count('image')
+            return 200, {'Content-Type': 'image/png'}, _PNG_IMAGE
+        if not path.endswith('api.php'):
+            return 404, {}, b"Not found"
+
+        action = params.get('action')
+        if action == 'parse':
+            data = self._parse(params)
+        elif action == 'query':
+            data = self._query(params)
+        else:
+            data = _api_error('badvalue', "Unrecognized value for action.")
+        self._count(action if 'error' not in data else 'missing')
+
+        return 200, {'Content-Type': 'application/json'}, _json_body(data)
+
+    def _count(self, name, num=1):
+        with self._lock:
+            self._stats[name] = self._stats.get(name, 0) + num
+
+    def _parse(self, params):
+        redirects = []
+        if 'oldid' in params:
+            revid = int(params['oldid'])
+            page_title = self.corpus.revision_title(revid)
+            page_data = None if page_title is None else \
+                self.corpus.page(page_title)
+            if page_data is None:
+                return _api_error('nosuchrevid', "There is no revision "
+                                  "with ID {0:d}.".format(revid))
+            page_data = dict(page_data, revid=revid)
+        else:
+            page_title = params.get('page', '')
+            page_data = self.corpus.page(page_title)
+            if page_data is None:
+                return _api_error('missingtitle', "The page you specified "
+                                  "doesn't exist.")
+            if wikicache.alias_key(page_title) != \
+                    wikicache.alias_key(page_data['title']):
+                redirects = [{'from': page_title.replace('_', ' '),
+                              'to': page_data['title']}]
+
+        if 'text' in page_data:
+            text = page_data['text']['*'].replace(
+                '//upload.wikimedia.org/', '//' + self.base_url[7:] +
+                '/upload/')
+            page_data = dict(page_data, text={'*': text})
+        if redirects:
+            page_data = dict(page_data, redirects=redirects)
+        if 'prop' in params:
+            keep = set(params['prop'].split('|')) | \
+                set(['title', 'pageid', 'redirects'])
+            page_data = {x: y for x, y in page_data.items() if x in keep}
+
+        return dict(parse=page_data)
+
+    def _query(self, params):
+        props = params.get('prop', '').split('|')
+        if 'revisions' in props and 'pageids' in params:
+            return self._query_revisions(params)
+        if 'titles' in params:
+            return self._query_titles(params, props)
+
+        return _api_error('invalidparammix', "Give titles, or pageids with "
+                          "prop=revisions.")
+
+    def _query_revisions(self, params):
+        pageid = int(params['pageids'])
+        page_title = self.corpus.pageid_title(pageid)
+        if page_title is None:
+            return _api_error('nosuchpageid', "There is no page with ID "
+                              "{0:d}.".format(pageid))
+
+        revisions = self.corpus.revisions(page_title)
+        start_id = params.get('rvcontinue', params.get('rvstartid'))
+        start = 0
+        if start_id is not None:
+            start_id = int(start_id.split('|')[-1])
+            start = next((i for i, x in enumerate(revisions) if
+                          x['revid'] <= start_id), len(revisions))
+        end = start + self.revisions_per_page
+
+        page = dict(pageid=pageid, ns=0, title=page_title.replace('_', ' '),
+                    revisions=revisions[start:end])
+        data = dict(batchcomplete='', query=dict(pages={str(pageid): page}))
+        if end < len(revisions):
+            rvcontinue = "{0:s}|{1:d}".format(
+                revisions[end]['timestamp'].replace('-', '').replace(
+                    ':', '').replace('T', '').rstrip('Z'),
+                revisions[end]['revid'])
+            data['continue'] = {'rvcontinue': rvcontinue, 'continue': '||'}
+
+        return data
+
+    def _query_titles(self, params, props):
+        pages = []
+        normalized = []
+        redirects = []
+        for page_title in params['titles'].split('|'):
+            display = wikicache.alias_key(page_title).replace('_', ' ')
+            if display != page_title:
+                normalized.append({'from': page_title, 'to': display})
+            page_data = self.corpus.page(page_title)
+            if page_data is None:
+                pages.append(dict(ns=0, title=display, missing=True))
+                continue
+            if display != page_data['title']:
+                redirects.append({'from': display, 'to': page_data['title']})
+            pages.append(_query_page(page_data, props))
+
+        return dict(batchcomplete=True,
+                    query=dict(normalized=normalized, redirects=redirects,
+                               pages=pages))
+
+
+class SyntheticCorpus():
+    """Generated pages named 'Page_0', 'Page_1' and so on.
+
+    Every page has a few paragraphs and a list, each holding links to
+    other pages of the corpus, sections, images, language links and
+    external links; it is generated from its title when requested, so
+    the corpus takes no memory. The title 'Redirect_<n>' redirects to
+    'Page_<n>'.
+
+    Args:
+        num_pages: Number of pages in the corpus.
+        num_links: Number of links on each page.
+        num_paragraphs: Number of paragraphs on each page.
+        num_revisions: Number of revisions in the history of each page,
+            at most 1000.
+    """
+    def __init__(self, num_pages=1000, num_links=40, num_paragraphs=8,
+                 num_revisions=36):
+        self.num_pages = num_pages
+        self.num_links = num_links
+        self.num_paragraphs = num_paragraphs
+        self.num_revisions = num_revisions
+
+    def page(self, page_title):
+        """Returns the data of a page as the parse action does, or None.
+        """
+        num = self._page_number(page_title)
+        if num is None:
+            return None
+
+        rng = random.Random(num)
+        page_title = "Page {0:d}".format(num)
+        links = sorted(set("Page_{0:d}".format(rng.randrange(self.num_pages))
+                           for _ in range(self.num_links)))
+        words = [page_title.lower().replace(' ', '')] + \
+            ["word{0:d}".format(rng.randrange(500)) for _ in range(50)]
+
+        html = ['<div class="mw-parser-output">']
+        per_block = max(1, len(links) // (self.num_paragraphs + 1))
+        for i in range(self.num_paragraphs):
+            if i == self.num_paragraphs // 2:
+                html.append('<h2><span class="mw-headline" id="Section_1">'
+                            'Section 1</span></h2>')
+                html.append('<div class="thumb"><img alt="" src="//upload.'
+                            'wikimedia.org/wikipedia/commons/a/ab/Image_'
+                            '{0:d}.jpg" width="320" height="240" /></div>'
+                            .format(num))
+            block = links[i * per_block:(i + 1) * per_block]
+            text = " ".join(rng.choice(words) for _ in range(60))
+            html.append("<p>" + text + " " + " ".join(
+                '<a href="/wiki/{0:s}" title="{1:s}">{1:s}</a>'.format(
+                    x, x.replace('_', ' ')) for x in block) + ".</p>")
+        html.append("<ul>" + "".join(
+            '<li><a href="/wiki/{0:s}">{0:s}</a></li>'.format(x) for x in
+            links[self.num_paragraphs * per_block:]) + "</ul>")
+        html.append("</div>")
+
+        return {
+            'title': page_title,
+            'pageid': num + 1,
+            'revid': 10 ** 7 + (num + 1) * 1000,
+            'displaytitle': page_title,
+            'text': {'*': "".join(html)},
+            'langlinks': [{'lang': x, 'url': 'https://' + x +
+                           '.wikipedia.org/wiki/Page_' + str(num),
+                           '*': page_title} for x in ('de', 'fr')],
+            'categories': [{'sortkey': '', '*': 'Synthetic_pages'}],
+            'links': [{'ns': 0, 'exists': '', '*': x.replace('_', ' ')}
+                      for x in links],
+            'templates': [],
+            'images': ["Image_{0:d}.jpg".format(num)],
+            'externallinks': ["https://example.org/page/{0:d}".format(num)],
+            'sections': [{'toclevel': 1, 'level': '2', 'line': 'Section 1',
+                          'number': '1', 'index': '1',
+                          'fromtitle': page_title.replace(' ', '_'),
+                          'byteoffset': 0, 'anchor': 'Section_1'}],
+            'iwlinks': [],
+            'properties': []
+        }
+
+    def pageid_title(self, pageid):
+        """Returns the title of the page with an id, or None.
+        """
+        if 1 <= pageid <= self.num_pages:
+            return "Page_{0:d}".format(pageid - 1)
+        return None
+
+    def revisions(self, page_title):
+        """Returns the revisions of a page, newest first.
+        """
+        page_data = self.page(page_title)
+        return _revision_history(page_data, self.num_revisions)
+
+    def revision_title(self, revid):
+        """Returns the title of the page with a revision, or None.
+        """
+        pageid = -((10 ** 7 - revid) // 1000)
+        if 10 ** 7 + pageid * 1000 - revid < self.num_revisions:
+            return self.pageid_title(pageid)
+        return None
+
+    def _page_number(self, page_title):
+        key = wikicache.alias_key(page_title)
+        for prefix in ('Page_', 'Redirect_'):
+            if key.startswith(prefix) and key[len(prefix):].isdigit():
+                num = int(key[len(prefix):])
+                if num < self.num_pages:
+                    return num
+        return None
+
+
+class CacheCorpus():
+    """Pages served from a cache backend of the wikicache module.
+
+    Titles are looked up through the alias index of the cache, so
+    redirects recorded there are followed. Revision histories are
+    generated from the revision id of each page, and the revision ids
+    handed out are remembered so that the pages can be served again by
+    revision.
+
+    Args:
+        cache: A cache backend, such as a wikicache.FileCache.
+        lang: Language of the pages to serve.
+        num_revisions: Number of revisions in the history of each page.
+    """
+    def __init__(self, cache, lang='en', num_revisions=36):
+        self.cache = cache
+        self.lang = lang
+        self.num_revisions = num_revisions
+        self._lock = threading.Lock()
+        self._pageids = None
+        self._revids = {}
+
+    def page(self, page_title):
+        """Returns the data of a page as the parse action does, or None.
+        """
+        key = self.cache.get_alias(page_title, self.lang)
+        if key is None:
+            key = wikicache.normalize_title(page_title)
+        if not self.cache.contains(key, self.lang):
+            return None
+
+        return self.cache.get(key, self.lang)
+
+    def pageid_title(self, pageid):
+        """Returns the title of the page with an id, or None.
+
+        The ids of all of the pages are read on the first call.
+        """
+        self._load_index()
+        return self._pageids.get(pageid)
+
+    def revisions(self, page_title):
+        """Returns the revisions of a page, newest first.
+        """
+        page_data = self.page(page_title)
+        revisions = _revision_history(page_data, self.num_revisions)
+        with self._lock:
+            for rev in revisions:
+                self._revids.setdefault(rev['revid'], page_title)
+
+        return revisions
+
+    def revision_title(self, revid):
+        """Returns the title of the page with a revision, or None.
+
+        Only the current revisions and those listed by revisions are known.
+        """
+        with self._lock:
+            if revid in self._revids:
+                return self._revids[revid]
+        self._load_index()
+        with self._lock:
+            return self._revids.get(revid)
+
+    def _load_index(self):
+        """Read the page and revision ids of every page, once.
+        """
+        with self._lock:
+            if self._pageids is not None:
+                return
+            self._pageids = {}
+            for key in self.cache.keys(self.lang):
+                page_data = self.cache.get(key, self.lang)
+                self._pageids[page_data.get('pageid')] = key
+                self._revids.setdefault(page_data.get('revid'), key)
+
+
+def main(argv=None):
+    """Run a WikiServer from the command line until interrupted.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Serve a local stand-in for the MediaWiki API.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="port to listen on")
+    parser.add_argument("--corpus", default=None,
+                        help="data directory or SQLite file of pages to "
+                             "serve (default: generated pages)")
+    parser.add_argument("--lang", default="en",
+                        help="language of the pages in the corpus")
+    parser.add_argument("--num-pages", type=int, default=1000,
+                        help="number of generated pages")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds to wait before each response")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="maximum extra seconds to wait at random")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="probability of a server error")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="probability of a 429 response")
+    parser.add_argument("--retry-after", type=int, default=1,
+                        help="seconds given in Retry-After headers")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed for the random choices of the server")
+    args = parser.parse_args(argv)
+
+    if args.corpus is None:
+        corpus = SyntheticCorpus(num_pages=args.num_pages)
+    else:
+        corpus = CacheCorpus(wikicache.open_cache(args.corpus), args.lang)
+
+    server = WikiServer(corpus, host=args.host, port=args.port,
+                        latency=args.latency, jitter=args.jitter,
+                        error_rate=args.error_rate,
+                        throttle_rate=args.throttle_rate,
+                        retry_after=args.retry_after, seed=args.seed)
+    server._bind()
+    print("Serving the MediaWiki API at " + server.api_url)
+    server.serve_forever()
+
+    return 0
+
+
+###############################################################################
+# Private functions
+
+class _Handler(BaseHTTPRequestHandler):
+    """Request handler passing GET requests on to the WikiServer.
+    """
+    protocol_version = 'HTTP/1.1'
+    server_version = 'wikiserver/' + str(__version__)
+    # headers and body are written separately; send them without delay
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(parts.query,
+                                             keep_blank_values=True))
+        status, headers, body = self.server.wiki_server._respond(parts.path,
+                                                                  params)
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.wiki_server._count('bytes', len(body))
+
+    def log_message(self, *args):
+        pass
+
+
+def _revision_history(page_data, num_revisions):
+    """Returns a generated list of revisions of a page, newest first.
+    """
+    if page_data is None:
+        return []
+
+    rng = random.Random(page_data['revid'])
+    size = len(page_data.get('text', {}).get('*', ''))
+    revisions = []
+    for index in range(num_revisions):
+        timestamp = _HISTORY_START - index * _HISTORY_STEP
+        revisions.append(dict(revid=page_data['revid'] - index,
+                              parentid=page_data['revid'] - index - 1,
+                              user="User{0:d}".format(rng.randrange(100)),
+                              timestamp=timestamp.strftime(
+                                  '%Y-%m-%dT%H:%M:%SZ'),
+                              size=max(0, size - index * rng.randrange(200)),
+                              comment="Revision {0:d}".format(index)))
+    revisions[-1]['parentid'] = 0
+
+    return revisions
+
+
+def _query_page(page_data, props):
+    """Returns the entry for a page in a response of the query action.
+    """
+    page = dict(pageid=page_data['pageid'], ns=0, title=page_data['title'],
+                lastrevid=page_data['revid'],
+                length=len(page_data.get('text', {}).get('*', '')))
+    if 'links' in props:
+        page['links'] = [dict(ns=x['ns'], title=x['*']) for x in
+                         page_data.get('links', [])]
+    if 'langlinks' in props:
+        page['langlinks'] = [dict(lang=x['lang'], title=x['*']) for x in
+                             page_data.get('langlinks', [])]
+    if 'categories' in props:
+        page['categories'] = [dict(ns=14, title='Category:' +
+                                   x['*'].replace('_', ' ')) for x in
+                              page_data.get('categories', [])]
+    if 'extlinks' in props:
+        page['extlinks'] = [dict(url=x) for x in
+                            page_data.get('externallinks', [])]
+    if 'images' in props:
+        page['images'] = [dict(ns=6, title='File:' + x.replace('_', ' '))
+                          for x in page_data.get('images', [])]
+
+    return page
+
+
+def _api_error(code, info):
+    return dict(error=dict(code=code, info=info))
+
+
+def _json_body(data):
+    return json.dumps(data).encode('UTF-8')
+
+
+def _png_image(width, height):
+    """Returns the bytes of a grey PNG image.
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data))
+
+    rows = b"".join(b"\x00" + b"\x80\x80\x80" * width for _ in range(height))
+    return b"\x89PNG\r\n\x1a\n" + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0,
+                                   0)) + \
+        chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b"")
+
+
+# Image returned for every request under '/upload/'
+_PNG_IMAGE = _png_image(320, 240)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -232,7 +232,12 @@ def _compute_meta_dataframe(links):
     """Convert links to a pandas DataFrame object
     """
     import pandas as pd
-    from wiki import get_wiki_json
+    from wiki import get_wiki_json, get_wiki_json_many
+
+    # fetch any uncached pages concurrently before building the table;
+    # the pages are then loaded one at a time to keep memory use flat
+    for _ in get_wiki_json_many(links):
+        pass
 
     meta = dict(link=[], title=[], doc=[], num_sections=[],
                 num_images=[], num_ilinks=[], num_elinks=[],